@@ -1,11 +1,24 @@
 #!/usr/bin/env python3
-import ast
+import copy
+import functools
 import logging
+import os
 import pickle
 import sqlite3
+import tempfile
 from urllib.parse import urlparse
 
-from tqdm import tqdm
+import pandas as pd
+
+from utils import (
+    ROLLUP,
+    Consumer,
+    Feature,
+    Scanner,
+    aggregate,
+    latest_visit_id,
+    stage_key,
+)
 
 logging.basicConfig(
     format="[%(asctime)s][%(levelname)s] %(name)s - %(message)s",
@@ -16,337 +29,592 @@ logger = logging.getLogger(__name__)
 
 DBNAME = "../data/crawl-data.sqlite"
 
+# Per-script features of every detector, see ScriptIndex.
+SCRIPT_INDEX = "cache/script_features.sqlite"
+SCRIPT_INDEX_VERSION = 1
+
+# Javascript rows buffered before they are aggregated.
+BATCH_ROWS = 100000
+
+# Bump these when the features of the corresponding detector change. Changing
+# only `detect` needs no bump, since verdicts are rolled up on every run.
+CANVAS_VERSION = 1
+FONT_VERSION = 1
+WEBRTC_VERSION = 1
+
 
 def get_base_url(url):
     o = urlparse(url)
     return o.netloc
 
 
-def query_javascript(conn, where):
-    """Return visit_id, cp_url, script_url, symbol, operation, value, args."""
-    c = conn.cursor()
+@functools.lru_cache()
+def symbol_ids(db_path):
+    """Return {symbol: id} of the database's js_symbols table.
 
-    count = c.execute(
-        f"""
-        SELECT count(*)
-        FROM site_visits AS s
-        JOIN javascript as j ON s.visit_id = j.visit_id
-        {where};
+    Returns None if some javascript rows have no symbol_id, e.g. for a crawl
+    older than js_symbols that hasn't been backfilled with
+    ``python -m automation.utilities.js_symbols``.
+    """
+    conn = sqlite3.connect(db_path)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(javascript)")]
+    interned = "symbol_id" in columns and not conn.execute(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM javascript
+            WHERE symbol_id IS NULL AND symbol IS NOT NULL
+        );
         """
     ).fetchone()[0]
-    query = f"""
-            SELECT
-                    s.visit_id,
-                    s.site_url,
-                    j.script_url,
-                    j.symbol,
-                    j.operation,
-                    j.value,
-                    j.arguments
-            FROM site_visits AS s
-            JOIN javascript as j ON s.visit_id = j.visit_id
-            {where};
-            """
-    logger.info(f"SQL Query: {query}")
-    return (count, c.execute(query))
+    ids = None
+    if interned:
+        rows = conn.execute("SELECT id, symbol FROM js_symbols;")
+        ids = {symbol: i for i, symbol in rows}
+    conn.close()
+    return ids
 
 
-def get_webrtc_fingerprinting():
-    """Return the sites which exhibit WebRTC fingerprinting."""
+class Fingerprinting:
+    """A fingerprinting heuristic over javascript calls.
 
-    try:
-        with open("cache/webrtc_fingerprinting.pkl", "rb") as f:
-            fingerprinting = pickle.load(f)
-            return fingerprinting
-    except FileNotFoundError:
-        conn = sqlite3.connect(DBNAME)
-        temp = dict()
-        fingerprinting = set()
-
-        count, rows = query_javascript(
-            conn,
-            """WHERE j.symbol LIKE '%RTCPeerConnection.localDescription%'
-               ORDER BY s.visit_id
-            """,
-        )
-        with tqdm(total=count) as pbar:
-            for row in rows:
-                (visit_id, site_url, script_url, symbol, operation, value, args) = row
-                pbar.update(1)
+    Subclasses set `cache`, `version` and `symbols` (substrings of the
+    symbols they need, matched like SQL LIKE), declare the `features` of
+    those calls the heuristic needs and implement `detect` over them. See
+    `utils.heuristics`. Features are indexed per script and visit by
+    `ScriptIndex`, and rolled up to sites or scripts to be judged.
 
-                if site_url not in temp:
-                    temp[site_url] = dict()
+    :cvar features: dict of name -> Feature over the javascript table
+    """
 
-                if "symbols" not in temp[site_url]:
-                    temp[site_url]["symbols"] = dict()
+    cache = None
+    version = None
+    symbols = ()
+    features = {}
 
-                if symbol not in temp[site_url]["symbols"]:
-                    temp[site_url]["symbols"][symbol] = dict()
+    @property
+    def name(self):
+        """Prefix of the detector's columns in the script index."""
+        return type(self).__name__
 
-                if operation not in temp[site_url]["symbols"][symbol]:
-                    temp[site_url]["symbols"][symbol][operation] = []
+    @property
+    def columns(self):
+        """Return the script index column of each feature, in order."""
+        return ["{}_{}".format(self.name, name) for name in self.features]
 
-                temp[site_url]["symbols"][symbol][operation].append((value, args))
+    @property
+    def calls(self):
+        """Return the script index column counting the detector's calls."""
+        return "{}__calls".format(self.name)
 
-        conn.close()
+    def condition(self, db_path):
+        """Return (condition, filter_symbols) selecting the calls to judge.
 
-        for key, value in tqdm(temp.items()):
-            base_url = get_base_url(key)
+        If `filter_symbols` is True, calls selected by the SQL condition must
+        still be filtered with `keep`.
+        """
+        ids = symbol_ids(db_path)
+        if ids is None:
+            condition = " OR ".join(
+                "symbol LIKE '%{}%'".format(pattern) for pattern in self.symbols
+            )
+            return (condition, True)
+
+        # Select calls by id, through javascript_symbol_id_visit, with `keep`
+        # applied to the symbol dictionary once.
+        wanted = sorted(i for symbol, i in ids.items() if self.matches(symbol))
+        return ("symbol_id IN ({})".format(",".join(map(str, wanted))), False)
+
+    def keep(self, symbol):
+        """Return False to skip calls to `symbol`."""
+        return True
+
+    def matches(self, symbol):
+        """Return True if calls to `symbol` are needed by the detector."""
+        # LIKE ignores the case of ASCII characters
+        return self.keep(symbol) and any(
+            pattern.lower() in symbol.lower() for pattern in self.symbols
+        )
 
-            if base_url in fingerprinting:
-                continue
+    def detect(self, features):
+        """Return which sites (or scripts) show fingerprinting.
 
-            # Check for fingerprinting. If yes, add to set
-            calls = temp[key]["symbols"]
+        :param features: DataFrame of `features` of the sites with at least
+            one relevant call
+        :returns: boolean Series over `features`' index
+        """
+        raise NotImplementedError
 
-            fingerprinting.add(base_url)
 
-        with open("cache/webrtc_fingerprinting.pkl", "wb") as fp:
-            pickle.dump(fingerprinting, fp)
+def call_of(*symbols, operation=None):
+    """Return an SQL expression true for calls to any of `symbols`."""
+    expression = "symbol IN ({})".format(", ".join("'{}'".format(s) for s in symbols))
+    if operation is not None:
+        expression += " AND operation = '{}'".format(operation)
+    return expression
 
-        return fingerprinting
 
+class WebRTCFingerprinting(Fingerprinting):
+    """Sites which exhibit WebRTC fingerprinting."""
 
-def get_font_fingerprinting():
-    """Return javascript which calls `measureText` method at least 50 times.
+    cache = "cache/webrtc_fingerprinting.pkl"
+    version = WEBRTC_VERSION
+    symbols = ("RTCPeerConnection.localDescription",)
+    features = {"calls": Feature("1", "count")}
+
+    def detect(self, features):
+        return features.calls > 0
+
+
+class FontFingerprinting(Fingerprinting):
+    """Javascript which calls `measureText` method at least 50 times.
 
     The `measureText` method should be called on the same text string.
     """
 
-    try:
-        with open("cache/font_fingerprinting.pkl", "rb") as f:
-            fingerprinting = pickle.load(f)
-            return fingerprinting
-    except FileNotFoundError:
-        conn = sqlite3.connect(DBNAME)
-        temp = dict()
-        fingerprinting = set()
-
-        count, rows = query_javascript(
-            conn,
-            """WHERE j.symbol LIKE '%CanvasRenderingContext2D.font%'
-                     OR j.symbol LIKE '%CanvasRenderingContext2D.measureText%'
-               ORDER BY s.visit_id
-            """,
+    cache = "cache/font_fingerprinting.pkl"
+    version = FONT_VERSION
+    symbols = (
+        "CanvasRenderingContext2D.font",
+        "CanvasRenderingContext2D.measureText",
+    )
+    features = {
+        "measure_text": Feature(
+            call_of("CanvasRenderingContext2D.measureText", operation="call"), "sum"
+        )
+    }
+
+    def detect(self, features):
+        return features.measure_text >= 50
+
+
+class CanvasFingerprinting(Fingerprinting):
+    """Channel providers that do canvas fingerprinting."""
+
+    cache = "cache/canvas_fingerprinting.pkl"
+    version = CANVAS_VERSION
+    symbols = ("HTMLCanvasElement", "CanvasRenderingContext2D")
+    features = {
+        "forbidden": Feature(
+            call_of(
+                "CanvasRenderingContext2D.save",
+                "CanvasRenderingContext2D.restore",
+                "HTMLCanvasElement.addEventListener",
+            ),
+            "max",
+        ),
+        "reads_image": Feature(
+            call_of(
+                "CanvasRenderingContext2D.getImageData", "HTMLCanvasElement.toDataURL"
+            ),
+            "max",
+        ),
+        "draws": Feature(
+            call_of(
+                "CanvasRenderingContext2D.fillStyle",
+                "CanvasRenderingContext2D.fillText",
+            ),
+            "max",
+        ),
+        # NaN if never set
+        "width_small": Feature(
+            "CASE WHEN {} THEN CAST(value AS INTEGER) <= 16 END".format(
+                call_of("HTMLCanvasElement.width", operation="set")
+            ),
+            "max",
+        ),
+        "height_small": Feature(
+            "CASE WHEN {} THEN CAST(value AS INTEGER) <= 16 END".format(
+                call_of("HTMLCanvasElement.height", operation="set")
+            ),
+            "max",
+        ),
+        # NaN if never called. Arguments are read with json1, and ignored if
+        # they aren't valid JSON.
+        "image_data_large": Feature(
+            """
+            CASE WHEN {} AND json_valid(arguments)
+            THEN ifnull(
+                json_extract(arguments, '$.2') >= 16
+                AND json_extract(arguments, '$.3') >= 16,
+                0
+            )
+            END
+            """.format(
+                call_of("CanvasRenderingContext2D.getImageData", operation="call")
+            ),
+            "max",
+        ),
+        "text_chars": Feature(
+            """
+            CASE WHEN {} AND json_valid(arguments)
+            THEN length(json_extract(arguments, '$.0'))
+            END
+            """.format(call_of("CanvasRenderingContext2D.fillText", operation="call")),
+            "sum",
+        ),
+        "fill_styles": Feature(
+            call_of("CanvasRenderingContext2D.fillStyle", operation="set"), "sum"
+        ),
+    }
+
+    def keep(self, symbol):
+        # Skip irrelevant symbols
+        return any(
+            s in symbol
+            for s in [
+                "font",
+                "fillText",
+                "fillStyle",
+                "height",
+                "width",
+                "toDataURL",
+                "getImageData",
+                "save",
+                "restore",
+                "addEventListener",
+            ]
         )
-        with tqdm(total=count) as pbar:
-            for row in rows:
-                (visit_id, site_url, script_url, symbol, operation, value, args) = row
-                pbar.update(1)
-
-                if site_url not in temp:
-                    temp[site_url] = dict()
 
-                if "symbols" not in temp[site_url]:
-                    temp[site_url]["symbols"] = dict()
+    def detect(self, features):
+        # MUST NOT have height and width below 16px. If the width is never
+        # set, assume the default canvas size of 300x150px.
+        too_small = features.width_small.eq(1) | (
+            features.width_small.eq(0) & features.height_small.eq(1)
+        )
+        return (
+            # MUST NOT call any of these
+            features.forbidden.eq(0)
+            # MUST call one of these
+            & features.reads_image.eq(1)
+            # MUST call one of these
+            & features.draws.eq(1)
+            & ~too_small
+            # If using getImageData, must get image > 16 x 16
+            & features.image_data_large.ne(0)
+            # Finally, must write text to canvas with two colors or 10+ chars
+            & ((features.text_chars >= 10) | (features.fill_styles >= 2))
+        )
 
-                if symbol not in temp[site_url]["symbols"]:
-                    temp[site_url]["symbols"][symbol] = dict()
 
-                if operation not in temp[site_url]["symbols"][symbol]:
-                    temp[site_url]["symbols"][symbol][operation] = []
+DETECTORS = (CanvasFingerprinting(), FontFingerprinting(), WebRTCFingerprinting())
 
-                temp[site_url]["symbols"][symbol][operation].append((value, args))
 
-        conn.close()
+class ScriptIndex(Consumer):
+    """Index the features of every detector per script and visit.
 
-        for key, value in tqdm(temp.items()):
-            base_url = get_base_url(key)
+    Each (site_url, visit_id, script_url) with a call relevant to any of
+    `detectors` gets a row in the script_features table of SCRIPT_INDEX,
+    holding each detector's features of the script's calls in the visit and
+    how many calls they were computed from. A visit's rows never change
+    once written, so refreshing the index only appends the visits after the
+    highest visit_id it covers, recorded in its meta table. Verdicts are
+    rolled up from it (see `rollup`), so detectors with new thresholds are
+    judged again without scanning javascript.
 
-            if base_url in fingerprinting:
-                continue
+    When scanned in parallel, each part writes its rows to a file of its own
+    next to the index as it goes, which the scanner then copies into the
+    index. The index is only written by the main process, in one
+    transaction.
+    """
 
-            # Check for fingerprinting. If yes, add to set
-            calls = temp[key]["symbols"]
+    def __init__(self, path=SCRIPT_INDEX, detectors=DETECTORS):
+        self.path = path
+        self.detectors = detectors
+        self.key = stage_key(
+            [SCRIPT_INDEX_VERSION] + [detector.version for detector in detectors]
+        )
+        self.conn = None
+        self.batch = []
+        # Whether this is a part, which writes to a file of its own
+        self.is_part = False
+        self.part_path = None
+
+        self.visits = None
+        if not os.path.exists(DBNAME):
+            return
+        after = self._covered()
+        conn = sqlite3.connect(DBNAME)
+        until = latest_visit_id(conn)
+        conn.close()
+        if until > after:
+            self.visits = (after, until)
+        else:
+            return
+
+        columns = ["script_url", "symbol"]
+        conditions = []
+        self.filters = []
+        for detector in detectors:
+            condition, filter_symbols = detector.condition(DBNAME)
+            conditions.append("({})".format(condition))
+            flag = "({}) AS {}".format(condition, detector.calls)
+            columns.append(flag)
+            columns.extend(
+                "({}) AS {}".format(feature.expression, column)
+                for feature, column in zip(detector.features.values(), detector.columns)
+            )
+            self.filters.append(filter_symbols)
+        self.tables = {"javascript": (columns, " OR ".join(conditions))}
+
+    def _covered(self):
+        """Return the highest visit_id in the index, or 0 to rebuild it."""
+        if not os.path.exists(self.path):
+            return 0
+        conn = sqlite3.connect(self.path)
+        try:
+            key, max_visit_id = conn.execute(
+                "SELECT key, max_visit_id FROM meta;"
+            ).fetchone()
+        except (sqlite3.OperationalError, TypeError):
+            # No meta table (yet)
+            return 0
+        finally:
+            conn.close()
+
+        if key != self.key:
+            logger.info("{} is stale, rebuilding".format(self.path))
+            return 0
+        return max_visit_id
+
+    def _features(self):
+        """Return {index column: Feature} of every detector."""
+        features = dict()
+        for detector in self.detectors:
+            features[detector.calls] = Feature(None, "count")
+            features.update(zip(detector.columns, detector.features.values()))
+        return features
+
+    def _connect(self):
+        """Return the connection to the index, or to a part's file, in a transaction."""
+        if self.conn is not None:
+            return self.conn
+
+        if self.is_part:
+            fd, self.part_path = tempfile.mkstemp(
+                prefix=os.path.basename(self.path) + ".",
+                suffix=".part",
+                dir=os.path.dirname(self.path) or ".",
+            )
+            os.close(fd)
+            conn = sqlite3.connect(self.part_path, isolation_level=None)
+            # A scratch file, deleted once merged
+            conn.execute("PRAGMA journal_mode = OFF;")
+            conn.execute("PRAGMA synchronous = OFF;")
+            conn.execute("BEGIN;")
+        else:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute("BEGIN;")
+            if not self.visits[0]:
+                conn.execute("DROP TABLE IF EXISTS script_features;")
+                conn.execute("DROP TABLE IF EXISTS meta;")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS script_features (
+                site_url TEXT, visit_id INTEGER, script_url TEXT, {}
+            );
+            """.format(
+                ", ".join("{} REAL".format(column) for column in self._features())
+            )
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT, max_visit_id INTEGER);"
+        )
+        self.conn = conn
+        return conn
+
+    def _store(self, table):
+        rows = table.reset_index().astype(object)
+        rows = rows.where(rows.notna(), None)
+        self._connect().executemany(
+            "INSERT INTO script_features VALUES ({});".format(
+                ",".join("?" * len(rows.columns))
+            ),
+            rows.itertuples(index=False, name=None),
+        )
 
-            try:
-                if len(calls["CanvasRenderingContext2D.measureText"]["call"]) >= 50:
-                    pass
+    def _flush(self):
+        if self.batch:
+            self._store(
+                aggregate(
+                    self._features(),
+                    self.batch,
+                    ["site_url", "visit_id", "script_url"],
+                )
+            )
+        self.batch = []
+
+    def visit(self, visit_id, site_url, rows):
+        for row in rows["javascript"]:
+            values = [site_url, visit_id, row["script_url"]]
+            for detector, filter_symbols in zip(self.detectors, self.filters):
+                if row[detector.calls] and (
+                    not filter_symbols or detector.keep(row["symbol"])
+                ):
+                    values.append(1)
+                    values.extend(row[column] for column in detector.columns)
                 else:
-                    continue
-            except KeyError:
-                # no call to measureText
-                continue
-
-            fingerprinting.add(base_url)
-
-        with open("cache/font_fingerprinting.pkl", "wb") as fp:
-            pickle.dump(fingerprinting, fp)
+                    values.extend([None] * (len(detector.features) + 1))
+            self.batch.append(values)
+
+        # A visit's rows are aggregated together.
+        if len(self.batch) >= BATCH_ROWS:
+            self._flush()
+
+    def part(self):
+        part = copy.copy(self)
+        part.batch = []
+        part.is_part = True
+        return part
+
+    def result(self):
+        """Return the path of the file holding the part's rows, if any."""
+        self._flush()
+        if self.conn is None:
+            return None
+        self.conn.execute("COMMIT;")
+        self.conn.close()
+        self.conn = None
+        return self.part_path
+
+    def merge(self, part_path):
+        if part_path is None:
+            return
+
+        part = sqlite3.connect(part_path)
+        try:
+            rows = part.execute("SELECT * FROM script_features;")
+            self._connect().executemany(
+                "INSERT INTO script_features VALUES ({});".format(
+                    ",".join("?" * len(rows.description))
+                ),
+                rows,
+            )
+        finally:
+            part.close()
+        os.remove(part_path)
+
+    def finish(self):
+        if self.visits is None:
+            return None
+
+        self._flush()
+        conn = self._connect()
+        conn.execute("DELETE FROM meta;")
+        conn.execute("INSERT INTO meta VALUES (?, ?);", (self.key, self.visits[1]))
+        conn.execute("COMMIT;")
+        conn.close()
+        self.conn = None
+        return None
 
-        return fingerprinting
 
+def rollup(conn, detector, by):
+    """Return the features of `detector` per `by`, from the script index.
 
-def get_canvas_fingerprinting():
-    """Find channel providers that do canvas fingerprinting."""
-
-    try:
-        with open("cache/canvas_fingerprinting.pkl", "rb") as f:
-            fingerprinting = pickle.load(f)
-            return fingerprinting
-    except FileNotFoundError:
-        conn = sqlite3.connect(DBNAME)
-        temp = dict()
-        fingerprinting = set()
-
-        count, rows = query_javascript(
-            conn,
-            """WHERE j.symbol LIKE '%HTMLCanvasElement%'
-                     OR j.symbol LIKE '%CanvasRenderingContext2D%'
-               ORDER BY s.visit_id
-            """,
-        )
-        with tqdm(total=count) as pbar:
-            for row in rows:
-                (visit_id, site_url, script_url, symbol, operation, value, args) = row
-                pbar.update(1)
-
-                # Skip irrelevant symbols
-                if not any(
-                    s in symbol
-                    for s in [
-                        "font",
-                        "fillText",
-                        "fillStyle",
-                        "height",
-                        "width",
-                        "toDataURL",
-                        "getImageData",
-                        "save",
-                        "restore",
-                        "addEventListener",
-                    ]
-                ):
-                    continue
-
-                if site_url not in temp:
-                    temp[site_url] = dict()
+    :param by: column of script_features to group by, e.g. "site_url" or
+        "script_url"
+    :returns: DataFrame of the features of each `by` with at least one call
+        relevant to the detector, indexed by `by`
+    """
+    columns = ", ".join(
+        "{}({}) AS {}".format(ROLLUP[feature.how], column, name)
+        for (name, feature), column in zip(detector.features.items(), detector.columns)
+    )
+    query = """
+        SELECT {by}, {columns}
+        FROM script_features
+        WHERE {calls} > 0
+        GROUP BY {by};
+        """.format(by=by, columns=columns, calls=detector.calls)
+    logger.info("SQL Query: {}".format(query))
+    features = pd.read_sql_query(query, conn, index_col=by)
+    return features.astype(float)
+
+
+def detected(conn, detector, by):
+    """Return the set of `by` whose calls pass `detector`'s heuristic."""
+    features = rollup(conn, detector, by)
+    return set(features.index[detector.detect(features).to_numpy(dtype=bool)])
+
+
+def get_fingerprinting(detector):
+    """Return the CPs of the sites passing `detector`, and cache them.
+
+    Call this once the script index is up to date.
+    """
+    if not os.path.exists(SCRIPT_INDEX):
+        # Caches shipped without the crawl database they were computed from
+        with open(detector.cache, "rb") as f:
+            return pickle.load(f)
 
-                if "symbols" not in temp[site_url]:
-                    temp[site_url]["symbols"] = dict()
+    conn = sqlite3.connect(SCRIPT_INDEX)
+    sites = detected(conn, detector, "site_url")
+    conn.close()
 
-                if symbol not in temp[site_url]["symbols"]:
-                    temp[site_url]["symbols"][symbol] = dict()
+    fingerprinting = {get_base_url(site_url) for site_url in sites}
+    with open(detector.cache, "wb") as fp:
+        pickle.dump(fingerprinting, fp)
+    return fingerprinting
 
-                if operation not in temp[site_url]["symbols"][symbol]:
-                    temp[site_url]["symbols"][symbol][operation] = []
 
-                temp[site_url]["symbols"][symbol][operation].append((value, args))
+def get_fingerprinting_scripts(detector):
+    """Return {script_url: CPs that loaded it} of the scripts passing `detector`.
 
-        conn.close()
+    Each script is judged on its own calls, over every visit that loaded it.
+    Call this once the script index is up to date.
+    """
+    conn = sqlite3.connect(SCRIPT_INDEX)
+    scripts = detected(conn, detector, "script_url")
+    rows = conn.execute(
+        """
+        SELECT DISTINCT script_url, site_url
+        FROM script_features
+        WHERE {} > 0;
+        """.format(detector.calls)
+    )
+    cps = {script_url: set() for script_url in scripts}
+    for script_url, site_url in rows:
+        if script_url in cps:
+            cps[script_url].add(get_base_url(site_url))
+    conn.close()
+    return cps
 
-        for key, value in tqdm(temp.items()):
-            base_url = get_base_url(key)
 
-            if base_url in fingerprinting:
-                continue
+def refresh_script_index():
+    """Add the visits the script index lacks."""
+    Scanner(DBNAME).run([ScriptIndex()])
 
-            # Check for fingerprinting. If yes, add to set
 
-            # MUST NOT call any of these
-            if any(
-                s in temp[key]["symbols"].keys()
-                for s in [
-                    "CanvasRenderingContext2D.save",
-                    "CanvasRenderingContext2D.restore",
-                    "HTMLCanvasElement.addEventListener",
-                ]
-            ):
-                continue
+def get_webrtc_fingerprinting():
+    """Return the sites which exhibit WebRTC fingerprinting."""
+    refresh_script_index()
+    return get_fingerprinting(WebRTCFingerprinting())
 
-            # MUST call one of these
-            if not any(
-                s in temp[key]["symbols"].keys()
-                for s in [
-                    "CanvasRenderingContext2D.getImageData",
-                    "HTMLCanvasElement.toDataURL",
-                ]
-            ):
-                continue
 
-            # MUST call one of these
-            if not any(
-                s in temp[key]["symbols"].keys()
-                for s in [
-                    "CanvasRenderingContext2D.fillStyle",
-                    "CanvasRenderingContext2D.fillText",
-                ]
-            ):
-                continue
-
-            calls = temp[key]["symbols"]
-
-            # MUST NOT have height and width below 16px
-            try:
-                if any(
-                    int(val[0]) <= 16 for val in calls["HTMLCanvasElement.width"]["set"]
-                ):
-                    continue
-                if any(
-                    int(val[0]) <= 16
-                    for val in calls["HTMLCanvasElement.height"]["set"]
-                ):
-                    continue
-            except KeyError:
-                # Assuming the default canvas sive of 300x150px
-                pass
+def get_font_fingerprinting():
+    """Return javascript which calls `measureText` method at least 50 times."""
+    refresh_script_index()
+    return get_fingerprinting(FontFingerprinting())
 
-            # If using getImageData, must get image > 16 x 16
-            try:
-                dims = calls["CanvasRenderingContext2D.getImageData"]["call"]
-                too_small = True
-                for val, args in dims:
-                    args = ast.literal_eval(args)
-                    if args["2"] >= 16 and args["3"] >= 16:
-                        too_small = False
-                        break
-                if too_small:
-                    continue
-            except KeyError:
-                pass
 
-            # Finally, must write text to canvas with two colors or 10+ chars
-            too_small = True
-            try:
-                cs = calls["CanvasRenderingContext2D.fillText"]["call"]
-                total_chars = 0
-                for val, args in cs:
-                    args = ast.literal_eval(args)
-                    total_chars += len(args["0"])
-                    if total_chars >= 10:
-                        too_small = False
-                        break
-            except KeyError:
-                pass
-            try:
-                if len(calls["CanvasRenderingContext2D.fillStyle"]["set"]) >= 2:
-                    too_small = False
-            except KeyError:
-                pass
-
-            if too_small:
-                continue
-
-            fingerprinting.add(base_url)
-
-        with open("cache/canvas_fingerprinting.pkl", "wb") as fp:
-            pickle.dump(fingerprinting, fp)
-
-        return fingerprinting
+def get_canvas_fingerprinting():
+    """Find channel providers that do canvas fingerprinting."""
+    refresh_script_index()
+    return get_fingerprinting(CanvasFingerprinting())
 
 
 def main():
 
-    canvas = get_canvas_fingerprinting()
+    # One pass over the javascript table for all three detectors.
+    refresh_script_index()
+    canvas, font, webrtc = (get_fingerprinting(d) for d in DETECTORS)
     #  print("Canvas Fingerprinting:")
     #  for site in sorted(canvas):
     #      print(f"{site}")
 
-    font = get_font_fingerprinting()
     #  print("\nFont Fingerprinting:")
     #  for site in sorted(font):
     #      print(f"{site}")
 
-    webrtc = get_webrtc_fingerprinting()
     #  print("\nWebRTC Fingerprinting:")
     #  for site in sorted(webrtc):
     #      print(f"{site}")
@@ -372,6 +640,16 @@ def main():
     for x in sorted(font.intersection(webrtc)):
         print(f"{x}")
 
+    # Third parties serving scripts that fingerprint on their own
+    if os.path.exists(SCRIPT_INDEX):
+        for detector in DETECTORS:
+            hosts = dict()
+            for script_url, cps in get_fingerprinting_scripts(detector).items():
+                hosts.setdefault(get_base_url(script_url), set()).update(cps)
+            print(f"\n\n{detector.name} script hosts:")
+            for host, cps in sorted(hosts.items(), key=lambda h: -len(h[1])):
+                print(f"{host} & {len(cps)} \\\\")
+
 
 if __name__ == "__main__":
     main()
@@ -1,3 +1,5 @@
+import importlib.util
+import ipaddress
 import logging
 from subprocess import DEVNULL, run
 
@@ -5,14 +7,21 @@ import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import requests
 import seaborn as sns
-from bs4 import BeautifulSoup
 from ipwhois import IPWhois
 from matplotlib.backends.backend_pdf import PdfPages
-from tqdm import tqdm
 
-from utils import get_channel_providers, total_stream_urls, urls_per_channel_provider
+from utils import (
+    Enricher,
+    RankIndex,
+    Service,
+    get_channel_providers,
+    host_table,
+    latex_rows,
+    memoize,
+    total_stream_urls,
+    urls_per_channel_provider,
+)
 
 logging.basicConfig(
     format="[%(asctime)s][%(levelname)s] %(name)s - %(message)s",
@@ -21,6 +30,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Bump when fetch_channel_provider_data changes. Its inputs live in Postgres,
+# in the GeoLite2 databases and on the web; its cache is keyed on the version
+# and the GeoLite2 databases.
+CP_DATA_VERSION = 3
+
+# GeoLocate lives in the collection's utils package, which shares its name
+# with ours, so it is loaded from its file. It reads the GeoLite2 databases
+# next to it.
+GEOLOCATE_PATH = "../collection/utils/geolocate.py"
+GEOLITE_FILES = (
+    "../collection/utils/GeoLite2-City.mmdb",
+    "../collection/utils/GeoLite2-ASN.mmdb",
+)
+
+# Results of the lookups made by fetch_channel_provider_data, reused by later
+# runs for the TTL of their service
+ENRICHMENT_CACHE = "cache/enrichment.sqlite"
+DAY = 24 * 60 * 60
+
 
 matplotlib.rcParams["text.usetex"] = True
 
@@ -28,37 +56,14 @@ sns.set(style="whitegrid")
 sns.set_context("paper", font_scale=1.7)
 
 
-def get_alexa_rank(base_url):
-    """Return the alexa global rank as an integer.
+def plot_alexa_distribution(data):
+    """Plot the distribution of the CPs' ranks on the top sites list.
 
-    If unranked, return a very large integer
+    See `utils.RankIndex` for the list used.
     """
-    # Ignore SSL errors
-    alexa_url = "https://www.alexa.com/siteinfo/" + base_url
-
-    page = requests.get(alexa_url)
-    soup = BeautifulSoup(page.text, "html.parser")
-    try:
-        globalrank = int(
-            soup.find("strong", {"class": "metrics-data align-vmiddle"})
-            .text.strip()
-            .replace(",", "")
-        )
-    except ValueError:
-        logger.error("Unable to find alexa rank on for {}".format(alexa_url))
-        globalrank = 11e5
-    except AttributeError:
-        logger.error("Unable to find alexa rank on for {}".format(alexa_url))
-        globalrank = 11e5
-
-    return globalrank
-
-
-def plot_alexa_distribution(data):
-    """Plot the alexa distribution."""
     fig, ax = plt.subplots(figsize=(6, 3))
 
-    df = data
+    df = pd.DataFrame({"globalrank": RankIndex().ranks(data["base_url"])})
 
     # Set up the matplotlib figure
     sns.despine()
@@ -73,7 +78,7 @@ def plot_alexa_distribution(data):
         ax=ax,
     )
     plot.set(ylabel=r"\# Channel Providers")
-    plot.set(xlabel=r"Alexa Global Rank")
+    plot.set(xlabel=r"Global Rank")
     plt.xlim([0, 11e5])
     plt.xticks([0, 2e5, 4e5, 6e5, 8e5, 1e6, 1.1e6])
     plt.yticks(np.arange(0, 150, 25))
@@ -93,46 +98,6 @@ def plot_alexa_distribution(data):
     )
 
 
-def sanatize_data(data):
-    """Merge the HOSTs which really are the same company."""
-
-    # Remove the Nulls
-    data.loc[data["host"].isnull(), "host"] = "N/A"
-
-    data.loc[data["host"].str.contains("SC-QUASI"), "host"] = "SC-QUASI"
-
-    data.loc[data["host"].str.contains("AMAZON"), "host"] = "AMAZON"
-
-    data.loc[data["host"].str.contains("SERVERIUS"), "host"] = "NL_SERVERIUS"
-
-    data.loc[data["host"].str.contains("GOOGLE"), "host"] = "GOOGLE"
-
-    data.loc[data["host"].str.contains("AMANAH"), "host"] = "AMANAH"
-
-    data.loc[data["host"].str.contains("DADDY"), "host"] = "GODADDY"
-
-    data.loc[data["host"].str.contains("CLIENTID"), "host"] = "PRIVATELAYER"
-
-    data.loc[data["host"].str.contains("PIHLTD"), "host"] = "PrivateInternetHosting"
-
-    data.loc[data["host"].str.contains("HostPalace"), "host"] = "HOSTPALACE"
-    data.loc[data["host"].str.contains("HOSTPALACE"), "host"] = "HOSTPALACE"
-
-    data.loc[data["host"].str.contains("MAROSNET"), "host"] = "MAROSNET"
-
-    data.loc[data["host"].str.contains("NAMEC"), "host"] = "NAMECHEAP"
-    data.loc[data["host"].str.contains("NCNET"), "host"] = "NAMECHEAP"
-
-    data.loc[data["host"].str.contains("IFASTNET"), "host"] = "IFASTNET"
-
-    data.loc[data["host"].str.contains("HETZNER"), "host"] = "HETZNER"
-
-    data.loc[data["host"].str.contains("DO-13"), "host"] = "DIGITALOCEAN"
-    data.loc[data["host"].str.contains("DIGITALOCEAN-23"), "host"] = "DIGITALOCEAN"
-
-    data.loc[data["host"].str.contains("OVH"), "host"] = "OVH"
-
-
 def print_host_table(data, num_rows=10):
     """Output the LaTeX table corresponding to a summary of CP hosts.
 
@@ -154,117 +119,119 @@ def print_host_table(data, num_rows=10):
 
     :param num_rows: The number of rows to show.
     """
-    sanatize_data(data)
-
-    stats = {}
-    for idx, row in data.iterrows():
-        if row["host"] == "N/A":
-            continue
-        if row["host"] in stats:
-            stats[row["host"]]["num_cps"] += 1
-            stats[row["host"]]["cps"].add(row["base_url"])
-
-            # check for inconsistencies
-            if (
-                row["host_country"]
-                and stats[row["host"]]["country"] != row["host_country"]
-            ):
-                if not stats[row["host"]]["country"]:
-                    stats[row["host"]]["country"] = row["host_country"]
-                else:
-                    logger.warning("{} != {}".format(stats[row["host"]], row))
-        else:
-            stats[row["host"]] = {
-                "country": row["host_country"]
-                if row["host_country"]
-                else row["asn_country"],
-                "as": row["asn_num"],
-                "num_cps": 1,
-                "cps": {row["base_url"]},
-            }
-
     # Yes, there may be a slight change in total number in between these
     # queries, but that change is likely extremely small.
     stream_counts = urls_per_channel_provider()
     total = total_stream_urls()
 
-    results = []
-    # Calculate the stream percentages
-    for key, value in stats.items():
-        host_streams = 0
-        for cp in value["cps"]:
-            host_streams += stream_counts[cp]
-
-        stats[key]["streams"] = host_streams
-
-        results.append(
-            (
-                key,
-                value["country"],
-                value["as"],
-                value["num_cps"],
-                100 * host_streams / total,
-            )
-        )
+    table = host_table(data, stream_counts, total)
+    latex_rows(table, "{} & {} & {} & {} & {} \\\\", num_rows)
 
-    results.sort(key=lambda x: x[3], reverse=True)
 
-    for host, country, asn, num_cps, percentage in results[:num_rows]:
-        print(
-            "{} & {} & {} & {} & {} \\\\".format(
-                host, country, asn, num_cps, percentage
-            )
-        )
+def _geolocate():
+    """Return a GeoLocate of the collection's utils."""
+    spec = importlib.util.spec_from_file_location("geolocate", GEOLOCATE_PATH)
+    geolocate = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(geolocate)
+    return geolocate.GeoLocate()
 
 
-def fetch_channel_provider_data():
-    """Add location and alexa rank information for a base_url.
+def _is_ip(ip):
+    """Return whether `ip` is an IPv4 or IPv6 address."""
+    try:
+        ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return True
+
+
+def lookup_rdap(ip):
+    """Return the AS and network of `ip` from its RDAP record."""
+    results = IPWhois(ip).lookup_rdap(depth=1)
+    return {
+        "asn": results["asn"],
+        "asn_country": results["asn_country_code"],
+        "host_country": results["network"]["country"],
+        "host": results["network"]["name"],
+    }
+
+
+ENRICHMENT_SERVICES = {"rdap": Service(lookup_rdap, ttl=30 * DAY, rate=5)}
 
+
+def _enrich(enricher, base_url, ip):
+    """Return the row of `base_url` for fetch_channel_provider_data, or None."""
+    try:
+        logger.info("{}: {}".format(base_url, ip))
+        whois = enricher.lookup("rdap", ip)
+    except Exception:
+        logger.warning("Skipping {}: {}".format(base_url, ip))
+        return None
+
+    return [
+        base_url,
+        whois["asn"],
+        whois["asn_country"],
+        whois["host_country"],
+        whois["host"],
+    ]
+
+
+@memoize("cache/cp_data.pkl", CP_DATA_VERSION, files=GEOLITE_FILES)
+def fetch_channel_provider_data(services=ENRICHMENT_SERVICES):
+    """Add location information for a base_url.
+
+    CPs are located with the GeoLite2 databases, in one batch that never
+    leaves the machine. GeoLite2 has no AS country, and the host of a CP is
+    its AS organization. Only the CPs whose AS GeoLite2 does not know are
+    looked up with RDAP, concurrently; see `utils.Enricher`. CPs whose RDAP
+    lookup fails are left out.
+
+    :param services: the "rdap" Service to look those CPs up with
     :rtype: Dataframe containing base_url, asn_num, asn_country, host_country,
-        host, globalrank.
+        host.
     """
+    cps = []
+    for base_url, ip in get_channel_providers():
+        if _is_ip(ip):
+            cps.append((base_url, ip))
+        else:
+            logger.warning("Skipping {}: {}".format(base_url, ip))
+
+    geo = _geolocate()
     try:
-        data = pd.read_pickle("cache/cp_data.pkl")
-    except FileNotFoundError:
-        url_map = {}
-        for base_url, ip in tqdm(get_channel_providers()):
-            try:
-                logger.info("{}: {}".format(base_url, ip))
-                obj = IPWhois(ip)
-                results = obj.lookup_rdap(depth=1)
-            except Exception:
-                logger.warning("Skipping {}: {}".format(base_url, ip))
-                continue
-
-            asn = results["asn"]
-            asn_country = results["asn_country_code"]
-            host_country = results["network"]["country"]
-            host = results["network"]["name"]
-
-            new_entry = [
-                base_url,
-                asn,
-                asn_country,
-                host_country,
-                host,
-                get_alexa_rank(base_url),
-            ]
-
-            url_map[base_url] = new_entry
-
-        # Make dataframe for plotting
-        data = pd.DataFrame(
-            list(url_map.values()),
-            columns=[
-                "base_url",
-                "asn_num",
-                "asn_country",
-                "host_country",
-                "host",
-                "globalrank",
-            ],
+        locations = geo.locate_many(ip for _, ip in cps)
+    finally:
+        geo.close()
+    rows = [
+        [base_url, location.asn, None, location.iso_code, location.organization]
+        for (base_url, _), location in zip(cps, locations)
+    ]
+
+    unknown = [i for i, location in enumerate(locations) if location.asn is None]
+    if unknown:
+        logger.info("Looking {} CPs up with RDAP".format(len(unknown)))
+        enricher = Enricher(services, ENRICHMENT_CACHE)
+        found = enricher.map(
+            lambda base_url, ip: _enrich(enricher, base_url, ip),
+            [cps[i] for i in unknown],
         )
-        data.to_pickle("cache/cp_data.pkl")
+        # CPs whose RDAP lookup failed are dropped.
+        for i, row in zip(unknown, found):
+            rows[i] = row
+        rows = [row for row in rows if row is not None]
+
+    # Make dataframe for plotting
+    data = pd.DataFrame(
+        rows,
+        columns=[
+            "base_url",
+            "asn_num",
+            "asn_country",
+            "host_country",
+            "host",
+        ],
+    )
     return data
 
 
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""Refresh every crawl analysis cache in a single pass over the database.
+
+Run this after a crawl (or once more of it has finished); tracking.py and
+fingerprinting.py then find their caches up to date.
+"""
+
+# Import tracking first so its logging configuration (tracking.log) wins.
+import tracking
+import fingerprinting
+from utils import Scanner
+
+
+def main():
+    Scanner(tracking.DBNAME).run(
+        [tracking.ThirdParties(), tracking.Cookies(), fingerprinting.ScriptIndex()]
+    )
+    for detector in fingerprinting.DETECTORS:
+        fingerprinting.get_fingerprinting(detector)
+
+
+if __name__ == "__main__":
+    main()
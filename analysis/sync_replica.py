@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""Mirror the stream database into a local SQLite replica.
+
+Run this while the cloud_sql_proxy is up; later syncs only fetch what changed.
+Then set STREAMS_REPLICA to the replica's path to run the analyses (and the
+collection's URL queries) against it, offline.
+"""
+
+import argparse
+import logging
+
+from utils.replica import REPLICA_PATH, sync
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "path", nargs="?", default=REPLICA_PATH, help="replica to create or update"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="[%(asctime)s][%(levelname)s] %(name)s - %(message)s",
+        level=logging.INFO,
+    )
+    sync(args.path)
+
+
+if __name__ == "__main__":
+    main()
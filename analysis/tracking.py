@@ -1,10 +1,9 @@
 #!/usr/bin/env python3
-import concurrent.futures
+import copy
 import json
 import logging
 import os
 import pickle
-import sqlite3
 from urllib.parse import urlparse
 from subprocess import DEVNULL, run
 
@@ -12,9 +11,7 @@ import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import psycopg2
 import seaborn as sns
-from tqdm import tqdm
 from matplotlib.backends.backend_pdf import PdfPages
 
 matplotlib.rcParams["text.usetex"] = True
@@ -22,9 +19,19 @@ sns.set(style="whitegrid")
 sns.set_context("paper", font_scale=1.7)
 sns.set_palette(sns.color_palette("colorblind"))
 
-from utils import EasyList
-
-GCSQL_PWD = os.environ["GCSQL_PWD"]
+from utils import (
+    ClassificationCache,
+    Consumer,
+    EasyList,
+    Scanner,
+    first_aggregators,
+    get_reddit_upvotes,
+    load_aggregates,
+    pending_visits,
+    stage_key,
+    write_aggregates,
+    write_watermark,
+)
 
 logging.basicConfig(
     format="[%(asctime)s][%(levelname)s] %(name)s - %(message)s",
@@ -33,11 +40,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-DELIMITER = "~^~"
-
 DBNAME = "../data/crawl-data.sqlite"
 
+# Minimum number of http_requests rows classified at once
+CHUNK_SIZE = 20000
+
+# Columns of http_requests a request is classified with, in the order of the
+# arguments of ClassificationCache.classify_requests
+REQUEST_COLUMNS = (
+    "url",
+    "top_level_url",
+    "content_policy_type",
+    "is_third_party_channel",
+)
+
+# Bump these when the code computing the corresponding cache changes.
+THIRD_PARTIES_VERSION = 2
+COOKIES_VERSION = 1
+
 EASYLIST = EasyList()
+CLASSIFIER = ClassificationCache(EASYLIST, "cache/url_classifications.sqlite")
 
 
 def get_base_url(url):
@@ -45,212 +67,286 @@ def get_base_url(url):
     return o.netloc
 
 
-def _process_row(row):
-    (visit_id, site_url, requests) = row
+def _process_chunk(visits):
+    """Return the partial per-CP aggregates of a chunk of visits.
+
+    Requests are classified with the options of rules, given the columns of
+    REQUEST_COLUMNS of each.
+
+    :param visits: list of (site_url, [third party requests])
+    :rtype: (number of visits, dict of base_url -> aggregates)
+    """
+    columns = zip(*(request for _, requests in visits for request in requests))
+    is_tracker = iter(CLASSIFIER.classify_requests(*columns))
+
+    third_parties = dict()
+    for site_url, requests in visits:
+        base_url = get_base_url(site_url)
+        if base_url not in third_parties:
+            third_parties[base_url] = {
+                "times_visited": 0,
+                "requests": set(),
+                "total_requests": 0,
+                "total_trackers": 0,
+            }
+        partial = third_parties[base_url]
+
+        partial["times_visited"] += 1
+        for request in requests:
+            partial["total_requests"] += 1
+            if next(is_tracker):
+                partial["requests"].add(request[0])
+                partial["total_trackers"] += 1
+
+    return (len(visits), third_parties)
+
+
+def _merge_third_parties(third_parties, partials):
+    """Fold the partial aggregates of a chunk into `third_parties`."""
+    for base_url, partial in partials.items():
+        if base_url not in third_parties:
+            third_parties[base_url] = {
+                "times_visited": 0,
+                "requests": dict(),
+                "total_requests": 0,
+                "total_trackers": 0,
+            }
+        aggregate = third_parties[base_url]
+
+        aggregate["times_visited"] += partial["times_visited"]
+        for tracking_request in partial["requests"]:
+            aggregate["requests"][tracking_request] = True
+        aggregate["total_requests"] += partial["total_requests"]
+        aggregate["total_trackers"] += partial["total_trackers"]
+
+
+def _merge_cookies(cookies, partials):
+    """Fold the cookie aggregates of some visits into `cookies`."""
+    for base_url, partial in partials.items():
+        if base_url not in cookies:
+            cookies[base_url] = {
+                "times_visited": 0,
+                "domains": dict(),
+                "total_domains": 0,
+                "total_trackers": 0,
+            }
+        aggregate = cookies[base_url]
+
+        aggregate["times_visited"] += partial["times_visited"]
+        aggregate["domains"].update(partial["domains"])
+        aggregate["total_domains"] += partial["total_domains"]
+        aggregate["total_trackers"] += partial["total_trackers"]
+
+
+def _load_json(cache, visits):
+    """Return the JSON cache to merge `visits` into, or a new one."""
+    if visits is None or not visits[0]:
+        return dict()
+    with open(cache) as handle:
+        return json.load(handle)
+
+
+def _save_json(cache, aggregates, visits, key):
+    with open(cache, "w") as fp:
+        json.dump(aggregates, fp)
+    write_watermark(cache, visits[1], key=key)
+
+
+class ThirdParties(Consumer):
+    """Aggregate third party requests per CP into cache/third_parties.json.
+
+    Requests are classified a chunk of visits at a time. A chunk is only cut
+    between visits, once it holds at least CHUNK_SIZE requests, so memory
+    stays flat no matter how large the database is. Classification runs in
+    the scanner's worker processes, one part per range of visits.
+    """
+
+    cache = "cache/third_parties.json"
+    tables = {"http_requests": (REQUEST_COLUMNS, "is_third_party_channel = 1")}
+
+    def __init__(self):
+        self.key = stage_key(THIRD_PARTIES_VERSION, files=[EASYLIST.path])
+        self.visits = pending_visits(
+            self.cache, os.path.exists(self.cache), DBNAME, self.key
+        )
+        self.third_parties = _load_json(self.cache, self.visits)
+        self.chunk = []
+        self.chunk_requests = 0
+
+    def _classify(self):
+        if self.chunk:
+            _, partials = _process_chunk(self.chunk)
+            _merge_third_parties(self.third_parties, partials)
+        self.chunk = []
+        self.chunk_requests = 0
+
+    def visit(self, visit_id, site_url, rows):
+        requests = [
+            tuple(row[column] for column in REQUEST_COLUMNS)
+            for row in rows["http_requests"]
+        ]
+        if not requests:
+            return
+
+        self.chunk.append((site_url, requests))
+        self.chunk_requests += len(requests)
+        if self.chunk_requests >= CHUNK_SIZE:
+            self._classify()
+
+    def part(self):
+        part = copy.copy(self)
+        part.third_parties = dict()
+        part.chunk = []
+        return part
+
+    def result(self):
+        self._classify()
+        return self.third_parties
+
+    def merge(self, third_parties):
+        _merge_third_parties(self.third_parties, third_parties)
+
+    def finish(self):
+        if self.visits is None:
+            return load_aggregates(self.cache, "requests")
+
+        self._classify()
+        _save_json(self.cache, self.third_parties, self.visits, self.key)
+        return write_aggregates(self.cache, self.third_parties, "requests")
+
+
+class Cookies(Consumer):
+    """Aggregate cookie domains per CP into cache/cookies.json."""
+
+    cache = "cache/cookies.json"
+    tables = {"profile_cookies": (("baseDomain",), None)}
+
+    def __init__(self):
+        self.key = stage_key(COOKIES_VERSION, files=[EASYLIST.path])
+        self.visits = pending_visits(
+            self.cache, os.path.exists(self.cache), DBNAME, self.key
+        )
+        self.cookies = _load_json(self.cache, self.visits)
 
-    base_url = get_base_url(site_url)
-    total_requests = 0
-    total_trackers = 0
-    tracking_requests = set()
+    def visit(self, visit_id, site_url, rows):
+        cookies = self.cookies
+        cookie_domains = [row["baseDomain"] for row in rows["profile_cookies"]]
+        if not cookie_domains:
+            return
 
-    if not requests:
-        return (base_url, set(), site_url, 0, 0)
+        base_url = get_base_url(site_url)
+        logger.debug("{}: {} cookies".format(site_url, len(cookie_domains)))
 
-    for request in requests.split(DELIMITER):
-        is_tracker = EASYLIST.rules.should_block(request)
-        total_requests += 1
-        if is_tracker:
-            tracking_requests.add(request)
-            total_trackers += 1
+        if base_url not in cookies:
+            cookies[base_url] = dict()
+            cookies[base_url]["times_visited"] = 0
 
-    return (base_url, site_url, tracking_requests, total_requests, total_trackers)
+        cookies[base_url]["times_visited"] += 1
 
+        if "total_domains" not in cookies[base_url]:
+            cookies[base_url]["domains"] = dict()
+            cookies[base_url]["total_domains"] = 0
+            cookies[base_url]["total_trackers"] = 0
 
-def get_third_parties():
+        for cookie_domain, is_tracker in zip(
+            cookie_domains, CLASSIFIER.classify(cookie_domains)
+        ):
+            cookies[base_url]["domains"][cookie_domain] = is_tracker
+            cookies[base_url]["total_domains"] += 1
+            if is_tracker:
+                cookies[base_url]["total_trackers"] += 1
 
-    try:
-        with open("cache/third_parties.json") as handle:
-            third_parties = json.loads(handle.read())
-            return third_parties
-    except FileNotFoundError:
-        conn = sqlite3.connect(DBNAME)
-        third_parties = dict()
-        c = conn.cursor()
-
-        count = c.execute("SELECT count(*) FROM site_visits AS s;").fetchone()[0]
-        c.execute(
-            """
-            SELECT
-                s.visit_id,
-                s.site_url,
-                (
-                    SELECT group_concat(url, '{}')
-                    FROM http_requests AS r
-                    WHERE s.visit_id = r.visit_id AND r.is_third_party_channel = 1
-                ) AS r_urls
-            FROM site_visits AS s;
-            """.format(
-                DELIMITER
-            )
-        )
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            with tqdm(total=count) as pbar:
-                for (
-                    base_url,
-                    site_url,
-                    tracking_requests,
-                    total_requests,
-                    total_trackers,
-                ) in executor.map(_process_row, c):
-                    pbar.update(1)
+    def part(self):
+        part = copy.copy(self)
+        part.cookies = dict()
+        return part
 
-                    if total_requests == 0:
-                        continue
+    def result(self):
+        return self.cookies
 
-                    if base_url not in third_parties:
-                        third_parties[base_url] = dict()
-                        third_parties[base_url]["times_visited"] = 0
+    def merge(self, cookies):
+        _merge_cookies(self.cookies, cookies)
 
-                    third_parties[base_url]["times_visited"] += 1
+    def finish(self):
+        if self.visits is None:
+            return load_aggregates(self.cache, "domains")
 
-                    if "total_requests" not in third_parties[base_url]:
-                        third_parties[base_url]["requests"] = dict()
-                        third_parties[base_url]["total_requests"] = 0
-                        third_parties[base_url]["total_trackers"] = 0
+        _save_json(self.cache, self.cookies, self.visits, self.key)
+        return write_aggregates(self.cache, self.cookies, "domains")
 
-                    for tracking_request in tracking_requests:
-                        third_parties[base_url]["requests"][tracking_request] = True
 
-                    third_parties[base_url]["total_requests"] += total_requests
-                    third_parties[base_url]["total_trackers"] += total_trackers
+def get_third_parties():
+    """Return third party request aggregates per CP as CPAggregates.
 
-        conn.close()
-        with open("cache/third_parties.json", "w") as fp:
-            json.dump(third_parties, fp)
-        return third_parties
+    The cache is refreshed with any visits newer than its watermark.
+    """
+    return Scanner(DBNAME).run([ThirdParties()])[0]
 
 
 def get_cookies():
+    """Return cookie domain aggregates per CP as CPAggregates.
 
-    try:
-        with open("cache/cookies.json") as handle:
-            cookies = json.loads(handle.read())
-            return cookies
-    except FileNotFoundError:
-        conn = sqlite3.connect(DBNAME)
-        cookies = dict()
-        c = conn.cursor()
-
-        count = c.execute("SELECT count(*) FROM site_visits AS s;").fetchone()[0]
-
-        with tqdm(total=count) as pbar:
-            for row in c.execute(
-                """
-                SELECT
-                    s.visit_id,
-                    s.site_url,
-                    (
-                        SELECT group_concat(baseDomain, '{}')
-                        FROM profile_cookies AS p
-                        WHERE s.visit_id = p.visit_id
-                    ) AS p_cookies
-                FROM site_visits AS s;
-                """.format(
-                    DELIMITER
-                )
-            ):
-                pbar.update(1)
-                (visit_id, site_url, cookie_domains) = row
-
-                if not cookie_domains:
-                    continue
-
-                base_url = get_base_url(site_url)
-
-                cookie_domains = cookie_domains.split(DELIMITER)
-                logger.debug("{}: {} cookies".format(site_url, len(cookie_domains)))
-
-                if base_url not in cookies:
-                    cookies[base_url] = dict()
-                    cookies[base_url]["times_visited"] = 0
-
-                cookies[base_url]["times_visited"] += 1
-
-                if "total_domains" not in cookies[base_url]:
-                    cookies[base_url]["domains"] = dict()
-                    cookies[base_url]["total_domains"] = 0
-                    cookies[base_url]["total_trackers"] = 0
-
-                for cookie_domain in cookie_domains:
-                    is_tracker = EASYLIST.rules.should_block(cookie_domain)
-                    cookies[base_url]["domains"][cookie_domain] = is_tracker
-                    cookies[base_url]["total_domains"] += 1
-                    if is_tracker:
-                        cookies[base_url]["total_trackers"] += 1
-
-        conn.close()
-        with open("cache/cookies.json", "w") as fp:
-            json.dump(cookies, fp)
-    return cookies
+    The cache is refreshed with any visits newer than its watermark.
+    """
+    return Scanner(DBNAME).run([Cookies()])[0]
 
 
-def latex_cookies(cookies, num_rows=10):
-    all_cps = []
-    for key, value in cookies.items():
-        domains = value["total_domains"]
-        trackers = value["total_trackers"]
-        trackers_per_page = trackers / value["times_visited"]
-        percentage = (trackers / domains) * 100
-        all_cps.append((key, domains, trackers, trackers_per_page, percentage))
+def _latex_per_cp(aggregates, num_rows):
+    """Print the CPs with the most trackers per page and return them all.
 
-    # sort by percentage
-    all_cps.sort(key=lambda x: x[3], reverse=True)
+    :rtype: List of (cp, total, trackers, trackers_per_page, percentage),
+        sorted by trackers_per_page.
+    """
+    trackers_per_page = aggregates.trackers / aggregates.times_visited
+    percentage = (aggregates.trackers / aggregates.totals) * 100
+
+    # sort by trackers per page
+    order = np.argsort(-trackers_per_page, kind="stable")
+
+    all_cps = [
+        (
+            aggregates.cps[i],
+            int(aggregates.totals[i]),
+            int(aggregates.trackers[i]),
+            float(trackers_per_page[i]),
+            float(percentage[i]),
+        )
+        for i in order
+    ]
 
     for cp, d, t, ttp, p in all_cps[:num_rows]:
         print("\\url{{{}}} & {:.2f} & {:.2f} \\\\".format(cp, p, ttp))
-
     return all_cps
 
 
-def latex_third_parties(third_parties, num_rows=10):
-    all_cps = []
-    for key, value in third_parties.items():
-        requests = value["total_requests"]
-        trackers = value["total_trackers"]
-        trackers_per_page = trackers / value["times_visited"]
-        percentage = (trackers / requests) * 100
-        all_cps.append((key, requests, trackers, trackers_per_page, percentage))
+def latex_cookies(cookies, num_rows=10):
+    return _latex_per_cp(cookies, num_rows)
 
-    # sort by percentage
-    all_cps.sort(key=lambda x: x[3], reverse=True)
 
-    for cp, d, t, ttp, p in all_cps[:num_rows]:
-        print("\\url{{{}}} & {:.2f} & {:.2f} \\\\".format(cp, p, ttp))
-    return all_cps
+def latex_third_parties(third_parties, num_rows=10):
+    return _latex_per_cp(third_parties, num_rows)
 
 
 def latex_most_common_trackers(third_parties, num_rows=10):
 
-    all_trackers = dict()
-    total_tracking_domains = 0
-    for key, value in third_parties.items():
-        for domain, is_tracker in value["requests"].items():
-            base_url = get_base_url(domain)
-            if base_url not in all_trackers:
-                all_trackers[base_url] = 0
-
-            all_trackers[base_url] += 1
-            total_tracking_domains += 1
-
-    top_trackers = []
-    for key, value in all_trackers.items():
-        top_trackers.append((key, value, (value / total_tracking_domains) * 100))
+    # Parse each distinct URL once, then count its domain for every CP it was
+    # requested on.
+    domains, domain_of_url = np.unique(
+        [get_base_url(url) for url in third_parties.items], return_inverse=True
+    )
+    pair_domains = domain_of_url[third_parties.pair_item]
+    counts = np.bincount(pair_domains, minlength=len(domains))
+    total_tracking_domains = len(pair_domains)
 
-    # sort by percentage
-    top_trackers.sort(key=lambda x: x[2], reverse=True)
+    # Ties keep the order in which the domains were first seen.
+    _, first_seen = np.unique(pair_domains, return_index=True)
+    seen = np.flatnonzero(counts)
+    order = seen[np.lexsort((first_seen, -counts[seen]))]
 
-    for d, v, p in top_trackers[:num_rows]:
-        print("\\url{{{}}} & {} & {:.2f} \\\\".format(d, v, p))
+    for i in order[:num_rows]:
+        v = int(counts[i])
+        p = (v / total_tracking_domains) * 100
+        print("\\url{{{}}} & {} & {:.2f} \\\\".format(domains[i], v, p))
 
 
 def calc_privacy_score(tp_list, cookie_list, num_rows=10):
@@ -337,34 +433,11 @@ def calc_privacy_score(tp_list, cookie_list, num_rows=10):
 
 
 def agg_privacy_scores(scores):
-    # Init db connection
-    conn = psycopg2.connect(
-        host="localhost",
-        port="6543",
-        dbname="postgres",
-        user="postgres",
-        password=GCSQL_PWD,
-    )
-    cur = conn.cursor()
-    get_agg_cmd = "SELECT aggregator FROM stream_urls WHERE base_url = (%s)"
-    all_aggs = {}
-    aggs_for_bp = []
-    for key in scores:
-        cur.execute(get_agg_cmd, (key,))
-        rows = cur.fetchall()
-        aggregator = rows[0][0]
-        aggs_for_bp.append([aggregator, scores[key]])
-        if aggregator not in all_aggs:
-            all_aggs[aggregator] = (scores[key], 1)
-        else:
-            all_aggs[aggregator] = (
-                all_aggs[aggregator][0] + scores[key],
-                all_aggs[aggregator][1] + 1,
-            )
-    agg_score_dict = {}
-    for key in all_aggs:
-        agg_score_dict[key] = all_aggs[key][0] / all_aggs[key][1]
-    return agg_score_dict, aggs_for_bp
+    per_cp = pd.DataFrame({"score": list(scores.values())}, index=list(scores))
+    per_cp["aggregator"] = first_aggregators(scores)
+    agg_scores = per_cp.groupby("aggregator", sort=False)["score"].mean()
+    aggs_for_bp = per_cp[["aggregator", "score"]].values.tolist()
+    return agg_scores.to_dict(), aggs_for_bp
 
 
 def gen_boxplots(entries):
@@ -419,28 +492,17 @@ def latex_all_privacy_scores(scores, num_rows=15):
 
 
 def privacy_vs_upvotes(scores):
-    # Init db connection
-    conn = psycopg2.connect(
-        host="localhost",
-        port="6543",
-        dbname="postgres",
-        user="postgres",
-        password=GCSQL_PWD,
-    )
-    cur = conn.cursor()
-    get_votes_cmd = "SELECT upvotes FROM stream_urls WHERE aggregator = 'reddit' AND base_url = (%s)"
     all_cps = {}
     for key in scores:
-        cur.execute(get_votes_cmd, (key,))
-        rows = cur.fetchall()
-        if not rows:
+        upvotes = get_reddit_upvotes(key)
+        if not upvotes:
             # Stream not from reddit!
             continue
         vote_total = 0
         vote_count = 0
-        for vote in rows:
-            if vote[0] < -1 or vote[0] > 2:
-                vote_total += vote[0]
+        for vote in upvotes:
+            if vote < -1 or vote > 2:
+                vote_total += vote
                 vote_count += 1
         if vote_count > 0:
             avg_upvotes = vote_total / vote_count
@@ -471,13 +533,11 @@ def latex_privacy_upvotes(scores):
 
 def main():
 
-    cookies = get_cookies()
+    cookies, third_parties = Scanner(DBNAME).run([Cookies(), ThirdParties()])
     print("Tracking Cookies per CP: ")
     all_cps_cook = latex_cookies(cookies, num_rows=15)
     print()
 
-    third_parties = get_third_parties()
-
     print("Tracking HTTP Requests per CP: ")
     all_cps_tp = latex_third_parties(third_parties)
     print()
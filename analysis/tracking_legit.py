@@ -7,7 +7,6 @@ directly associated with streaming, but with news etc.
 """
 
 import concurrent.futures
-import json
 import logging
 import pickle
 import sqlite3
@@ -17,7 +16,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 from tqdm import tqdm
 
-from utils import EasyList
+from utils import ClassificationCache, EasyList, memoize
 
 logging.basicConfig(
     format="[%(asctime)s][%(levelname)s] %(name)s - %(message)s",
@@ -31,6 +30,11 @@ DELIMITER = "~^~"
 DBNAME = "../data_real_sites/crawl-data.sqlite"
 
 EASYLIST = EasyList()
+CLASSIFIER = ClassificationCache(EASYLIST, "cache/url_classifications.sqlite")
+
+# Bump these when the code computing the corresponding cache changes.
+THIRD_PARTIES_VERSION = 1
+COOKIES_VERSION = 1
 
 
 def get_base_url(url):
@@ -55,8 +59,8 @@ def _process_row(row):
         return (base_url, set(), site_url, 0, 0)
     print("TRY AGAIN")
 
-    for request in requests.split(DELIMITER):
-        is_tracker = EASYLIST.rules.should_block(request)
+    requests = requests.split(DELIMITER)
+    for request, is_tracker in zip(requests, CLASSIFIER.classify(requests)):
         total_requests += 1
         if is_tracker:
             tracking_requests.add(request)
@@ -65,131 +69,127 @@ def _process_row(row):
     return (base_url, site_url, tracking_requests, total_requests, total_trackers)
 
 
+@memoize(
+    "cache/third_parties_real.json",
+    THIRD_PARTIES_VERSION,
+    db=DBNAME,
+    files=[EASYLIST.path],
+)
 def get_third_parties():
 
-    try:
-        with open("cache/third_parties_real.json") as handle:
-            third_parties =json.loads(handle.read())
-            return third_parties
-    except FileNotFoundError:
-        conn = sqlite3.connect(DBNAME)
-        third_parties = dict()
-        c = conn.cursor()
-
-        count = c.execute("SELECT count(*) FROM site_visits AS s;").fetchone()[0]
-        c.execute(
-            """
-            SELECT
-                s.visit_id,
-                s.site_url,
-                (
-                    SELECT group_concat(url, '{}')
-                    FROM http_requests AS r
-                    WHERE s.visit_id = r.visit_id AND r.is_third_party_channel = 1
-                ) AS r_urls
-            FROM site_visits AS s;
-            """.format(
-                DELIMITER
-            )
+    conn = sqlite3.connect(DBNAME)
+    third_parties = dict()
+    c = conn.cursor()
+
+    count = c.execute("SELECT count(*) FROM site_visits AS s;").fetchone()[0]
+    c.execute(
+        """
+        SELECT
+            s.visit_id,
+            s.site_url,
+            (
+                SELECT group_concat(url, '{}')
+                FROM http_requests AS r
+                WHERE s.visit_id = r.visit_id AND r.is_third_party_channel = 1
+            ) AS r_urls
+        FROM site_visits AS s;
+        """.format(
+            DELIMITER
         )
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            with tqdm(total=count) as pbar:
-                for (
-                    base_url,
-                    site_url,
-                    tracking_requests,
-                    total_requests,
-                    total_trackers,
-                ) in executor.map(_process_row, c):
-                    pbar.update(1)
+    )
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        with tqdm(total=count) as pbar:
+            for (
+                base_url,
+                site_url,
+                tracking_requests,
+                total_requests,
+                total_trackers,
+            ) in executor.map(_process_row, c):
+                pbar.update(1)
 
-                    if total_requests == 0:
-                        continue
+                if total_requests == 0:
+                    continue
 
-                    if base_url not in third_parties:
-                        third_parties[base_url] = dict()
-                        third_parties[base_url]["times_visited"] = 0
+                if base_url not in third_parties:
+                    third_parties[base_url] = dict()
+                    third_parties[base_url]["times_visited"] = 0
 
-                    third_parties[base_url]["times_visited"] += 1
+                third_parties[base_url]["times_visited"] += 1
 
-                    if "total_requests" not in third_parties[base_url]:
-                        third_parties[base_url]["requests"] = dict()
-                        third_parties[base_url]["total_requests"] = 0
-                        third_parties[base_url]["total_trackers"] = 0
+                if "total_requests" not in third_parties[base_url]:
+                    third_parties[base_url]["requests"] = dict()
+                    third_parties[base_url]["total_requests"] = 0
+                    third_parties[base_url]["total_trackers"] = 0
 
-                    for tracking_request in tracking_requests:
-                        third_parties[base_url]["requests"][tracking_request] = True
+                for tracking_request in tracking_requests:
+                    third_parties[base_url]["requests"][tracking_request] = True
 
-                    third_parties[base_url]["total_requests"] += total_requests
-                    third_parties[base_url]["total_trackers"] += total_trackers
+                third_parties[base_url]["total_requests"] += total_requests
+                third_parties[base_url]["total_trackers"] += total_trackers
 
-        conn.close()
-        with open("cache/third_parties_real.json", "w") as fp:
-           json.dump(third_parties, fp)
-        return third_parties
+    conn.close()
+    return third_parties
 
 
+@memoize(
+    "cache/cookies_real.json", COOKIES_VERSION, db=DBNAME, files=[EASYLIST.path]
+)
 def get_cookies():
 
-    try:
-        with open("cache/cookies_real.json") as handle:
-            cookies = json.loads(handle.read())
-            return cookies
-    except FileNotFoundError:
-        conn = sqlite3.connect(DBNAME)
-        cookies = dict()
-        c = conn.cursor()
+    conn = sqlite3.connect(DBNAME)
+    cookies = dict()
+    c = conn.cursor()
 
-        count = c.execute("SELECT count(*) FROM site_visits AS s;").fetchone()[0]
+    count = c.execute("SELECT count(*) FROM site_visits AS s;").fetchone()[0]
 
-        with tqdm(total=count) as pbar:
-            for row in c.execute(
-                """
-                SELECT
-                    s.visit_id,
-                    s.site_url,
-                    (
-                        SELECT group_concat(baseDomain, '{}')
-                        FROM profile_cookies AS p
-                        WHERE s.visit_id = p.visit_id
-                    ) AS p_cookies
-                FROM site_visits AS s;
-                """.format(
-                    DELIMITER
-                )
-            ):
-                pbar.update(1)
-                (visit_id, site_url, cookie_domains) = row
+    with tqdm(total=count) as pbar:
+        for row in c.execute(
+            """
+            SELECT
+                s.visit_id,
+                s.site_url,
+                (
+                    SELECT group_concat(baseDomain, '{}')
+                    FROM profile_cookies AS p
+                    WHERE s.visit_id = p.visit_id
+                ) AS p_cookies
+            FROM site_visits AS s;
+            """.format(
+                DELIMITER
+            )
+        ):
+            pbar.update(1)
+            (visit_id, site_url, cookie_domains) = row
 
-                if not cookie_domains:
-                    continue
+            if not cookie_domains:
+                continue
 
-                base_url = get_base_url(site_url)
+            base_url = get_base_url(site_url)
 
-                cookie_domains = cookie_domains.split(DELIMITER)
-                logger.debug("{}: {} cookies".format(site_url, len(cookie_domains)))
+            cookie_domains = cookie_domains.split(DELIMITER)
+            logger.debug("{}: {} cookies".format(site_url, len(cookie_domains)))
 
-                if base_url not in cookies:
-                    cookies[base_url] = dict()
-                    cookies[base_url]["times_visited"] = 0
+            if base_url not in cookies:
+                cookies[base_url] = dict()
+                cookies[base_url]["times_visited"] = 0
 
-                cookies[base_url]["times_visited"] += 1
+            cookies[base_url]["times_visited"] += 1
 
-                if "total_domains" not in cookies[base_url]:
-                    cookies[base_url]["domains"] = dict()
-                    cookies[base_url]["total_domains"] = 0
-                    cookies[base_url]["total_trackers"] = 0
+            if "total_domains" not in cookies[base_url]:
+                cookies[base_url]["domains"] = dict()
+                cookies[base_url]["total_domains"] = 0
+                cookies[base_url]["total_trackers"] = 0
 
-                for cookie_domain in cookie_domains:
-                    is_tracker = EASYLIST.rules.should_block(cookie_domain)
-                    cookies[base_url]["domains"][cookie_domain] = is_tracker
-                    cookies[base_url]["total_domains"] += 1
-                    if is_tracker:
-                        cookies[base_url]["total_trackers"] += 1
+            for cookie_domain, is_tracker in zip(
+                cookie_domains, CLASSIFIER.classify(cookie_domains)
+            ):
+                cookies[base_url]["domains"][cookie_domain] = is_tracker
+                cookies[base_url]["total_domains"] += 1
+                if is_tracker:
+                    cookies[base_url]["total_trackers"] += 1
 
-        conn.close()
-        with open("cache/cookies_real.json", "w") as fp:
-           json.dump(cookies, fp)
+    conn.close()
     return cookies
 
 
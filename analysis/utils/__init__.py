@@ -1,13 +1,64 @@
 from utils.database import (
+    get_aggregators,
     get_channel_providers,
+    get_reddit_upvotes,
     total_stream_urls,
     urls_per_channel_provider,
 )
+from utils.aggregates import CPAggregates, load_aggregates, write_aggregates
+from utils.classification_cache import ClassificationCache
 from utils.easylist import EasyList
+from utils.enrichment import Enricher, Service
+from utils.heuristics import ROLLUP, Feature, aggregate
+from utils.memoize import db_fingerprint, memoize, stage_key
+from utils.ranks import UNRANKED, RankIndex
+from utils.scanner import Consumer, Scanner
+from utils.tables import (
+    aggregator_rollup,
+    first_aggregators,
+    host_table,
+    latex_rows,
+    normalize_hosts,
+    tracking_table,
+)
+from utils.watermark import (
+    latest_visit_id,
+    pending_visits,
+    read_watermark,
+    write_watermark,
+)
 
 __all__ = [
+    "CPAggregates",
+    "ClassificationCache",
+    "Consumer",
     "EasyList",
+    "Enricher",
+    "Feature",
+    "ROLLUP",
+    "RankIndex",
+    "Scanner",
+    "Service",
+    "UNRANKED",
+    "aggregate",
+    "aggregator_rollup",
+    "db_fingerprint",
+    "first_aggregators",
+    "get_aggregators",
     "get_channel_providers",
+    "get_reddit_upvotes",
+    "host_table",
+    "latest_visit_id",
+    "latex_rows",
+    "load_aggregates",
+    "memoize",
+    "normalize_hosts",
+    "pending_visits",
+    "read_watermark",
+    "stage_key",
     "total_stream_urls",
+    "tracking_table",
     "urls_per_channel_provider",
+    "write_aggregates",
+    "write_watermark",
 ]
@@ -0,0 +1,239 @@
+"""Columnar, memory mapped copies of the per-CP aggregate caches.
+
+The JSON caches written by tracking.py map each CP to its counters and to the
+items (third party URLs or cookie domains) seen on it. Parsing them builds
+millions of Python objects. Instead, each cache gets a columnar copy next to
+it, ``<cache>.columns``, holding the same data as NumPy arrays: one row per CP
+for the counters, one row per (CP, item) pair, and the strings as a UTF-8
+buffer plus offsets. The copy is memory mapped when loaded, so readers only
+touch the columns they use.
+
+The copy records a hash of the JSON it was built from and is rebuilt whenever
+the JSON changes.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from utils.memoize import file_digest
+
+logger = logging.getLogger(__name__)
+
+COLUMNS_MAGIC = b"CPAGGREG"
+COLUMNS_HEADER = struct.Struct("<8sI")
+COLUMNS_VERSION = 1
+ALIGNMENT = 8
+
+# Key of the item dict in a cache entry -> key of its total counter.
+TOTAL_KEYS = {"requests": "total_requests", "domains": "total_domains"}
+
+
+def columns_path(path):
+    """Return where the columnar copy of the JSON cache at `path` lives."""
+    root, _ = os.path.splitext(path)
+    return root + ".columns"
+
+
+class StringColumn:
+    """A read only sequence of strings stored as UTF-8 bytes plus offsets."""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(data, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.data[start:end].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class CPAggregates:
+    """Per-CP aggregates stored column by column.
+
+    :ivar cps: StringColumn of the CPs' base_urls
+    :ivar times_visited: visits of each CP
+    :ivar totals: total requests (or cookie domains) seen on each CP
+    :ivar trackers: how many of those were trackers
+    :ivar items: StringColumn of the distinct URLs (or cookie domains)
+    :ivar pair_cp: CP index of each (CP, item) pair
+    :ivar pair_item: item index of each (CP, item) pair
+    :ivar pair_tracker: whether the item of each pair is a tracker
+    """
+
+    STRING_COLUMNS = ("cps", "items")
+    ARRAY_COLUMNS = (
+        "times_visited",
+        "totals",
+        "trackers",
+        "pair_cp",
+        "pair_item",
+        "pair_tracker",
+    )
+
+    def __init__(self, **columns):
+        for name, column in columns.items():
+            setattr(self, name, column)
+
+    def __len__(self):
+        return len(self.times_visited)
+
+    @classmethod
+    def from_dict(cls, aggregates, items):
+        """Convert aggregates as stored in the JSON caches.
+
+        :param items: key of the item dict in each entry, "requests" or
+            "domains"
+        """
+        total_key = TOTAL_KEYS[items]
+        item_index = dict()
+        pair_cp, pair_item, pair_tracker = [], [], []
+        for i, entry in enumerate(aggregates.values()):
+            for item, is_tracker in entry.get(items, {}).items():
+                pair_cp.append(i)
+                pair_item.append(item_index.setdefault(item, len(item_index)))
+                pair_tracker.append(is_tracker)
+
+        def counter(key):
+            return np.fromiter(
+                (entry.get(key, 0) for entry in aggregates.values()),
+                dtype=np.int64,
+                count=len(aggregates),
+            )
+
+        return cls(
+            cps=StringColumn.from_strings(aggregates.keys()),
+            times_visited=counter("times_visited"),
+            totals=counter(total_key),
+            trackers=counter("total_trackers"),
+            items=StringColumn.from_strings(item_index.keys()),
+            pair_cp=np.array(pair_cp, dtype=np.int32),
+            pair_item=np.array(pair_item, dtype=np.int32),
+            pair_tracker=np.array(pair_tracker, dtype=np.bool_),
+        )
+
+    def _arrays(self):
+        for name in self.STRING_COLUMNS:
+            column = getattr(self, name)
+            yield name + ".data", column.data
+            yield name + ".offsets", column.offsets
+        for name in self.ARRAY_COLUMNS:
+            yield name, getattr(self, name)
+
+    def save(self, path, source_digest):
+        """Write the columns to `path`, atomically.
+
+        :param source_digest: SHA-256 of the JSON cache the columns mirror
+        """
+        arrays = []
+        offset = 0
+        for name, array in self._arrays():
+            array = np.ascontiguousarray(array)
+            arrays.append((name, array, offset))
+            offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+        header = dict(
+            version=COLUMNS_VERSION,
+            source=source_digest,
+            columns={
+                name: dict(dtype=array.dtype.str, length=len(array), offset=offset)
+                for name, array, offset in arrays
+            },
+        )
+        header = json.dumps(header).encode("utf-8")
+        # Pad the header so the arrays that follow stay aligned.
+        header += b" " * (-(COLUMNS_HEADER.size + len(header)) % ALIGNMENT)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(COLUMNS_HEADER.pack(COLUMNS_MAGIC, len(header)))
+                f.write(header)
+                start = f.tell()
+                for name, array, offset in arrays:
+                    f.write(b"\0" * (start + offset - f.tell()))
+                    f.write(array.tobytes())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path, source_digest):
+        """Map the columns at `path`, raising ValueError if they are stale."""
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, header_len = COLUMNS_HEADER.unpack_from(buf)
+        if magic != COLUMNS_MAGIC:
+            raise ValueError("{} is not a columnar cache".format(path))
+
+        start = COLUMNS_HEADER.size
+        header = json.loads(buf[start : start + header_len].decode("utf-8"))
+        if header["version"] != COLUMNS_VERSION or header["source"] != source_digest:
+            raise ValueError("{} is out of date".format(path))
+
+        start += header_len
+        arrays = {
+            name: np.frombuffer(
+                buf,
+                dtype=np.dtype(column["dtype"]),
+                count=column["length"],
+                offset=start + column["offset"],
+            )
+            for name, column in header["columns"].items()
+        }
+        columns = {name: arrays[name] for name in cls.ARRAY_COLUMNS}
+        for name in cls.STRING_COLUMNS:
+            columns[name] = StringColumn(
+                arrays[name + ".data"], arrays[name + ".offsets"]
+            )
+        return cls(**columns)
+
+
+def write_aggregates(path, aggregates, items):
+    """Write the columnar copy of the JSON cache at `path` and return it.
+
+    Call this after the JSON cache itself has been written, with the same
+    `aggregates`. See `CPAggregates.from_dict` for `items`.
+    """
+    columns = columns_path(path)
+    digest = file_digest(path)
+    CPAggregates.from_dict(aggregates, items).save(columns, digest)
+    return CPAggregates.load(columns, digest)
+
+
+def load_aggregates(path, items):
+    """Return the aggregates of the JSON cache at `path` as CPAggregates.
+
+    The JSON is only parsed if its columnar copy is missing or out of date.
+    See `CPAggregates.from_dict` for `items`.
+    """
+    try:
+        return CPAggregates.load(columns_path(path), file_digest(path))
+    except (FileNotFoundError, ValueError, struct.error):
+        logger.info("Building the columnar copy of {}".format(path))
+
+    with open(path) as f:
+        aggregates = json.load(f)
+    return write_aggregates(path, aggregates, items)
@@ -0,0 +1,173 @@
+"""Persistent cache of EasyList verdicts shared across analysis runs."""
+
+import logging
+import os
+import sqlite3
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from utils.easylist import CONTENT_POLICY_TYPES
+
+logger = logging.getLogger(__name__)
+
+# Stay well below SQLite's limit on host parameters in a single statement.
+SQL_BATCH_SIZE = 500
+
+
+class ClassificationCache:
+    """Remember whether a URL is blocked by a given rule set.
+
+    Verdicts are keyed by (rule-set digest, URL), or for `classify_requests`
+    by the URL along with what rule options look at. Lookups hit an in-process
+    LRU first, then an SQLite database on disk, and only URLs seen by neither
+    are classified by `easylist`. New verdicts are written back in one
+    transaction per batch, so reruns (even after a crawl adds new visits) only
+    pay for URLs they have not seen before. Updating the list changes the
+    digest, which leaves old verdicts unused rather than wrong.
+
+    The connection is opened lazily in each process, so a module level
+    instance is safe to use from ProcessPoolExecutor workers.
+    """
+
+    def __init__(self, easylist, path, maxsize=2 ** 16):
+        self.easylist = easylist
+        self.digest = easylist.digest
+        self.requests_digest = easylist.digest + ":requests"
+        self.path = path
+        self.maxsize = maxsize
+        self._lru = OrderedDict()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        """Return this process's connection to the cache database."""
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+
+        conn = sqlite3.connect(self.path, timeout=60)
+        # WAL lets pool workers read while another one commits.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS classifications (
+                digest TEXT NOT NULL,
+                url TEXT NOT NULL,
+                blocked INTEGER NOT NULL,
+                PRIMARY KEY (digest, url)
+            ) WITHOUT ROWID
+            """
+        )
+        conn.commit()
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def _remember(self, key, blocked):
+        self._lru[key] = blocked
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+    def _lookup(self, digest, keys):
+        """Return the stored verdicts for `keys` as a dict."""
+        conn = self._connect()
+        found = dict()
+        for i in range(0, len(keys), SQL_BATCH_SIZE):
+            batch = keys[i : i + SQL_BATCH_SIZE]
+            rows = conn.execute(
+                "SELECT url, blocked FROM classifications "
+                "WHERE digest = ? AND url IN ({})".format(",".join("?" * len(batch))),
+                [digest] + batch,
+            )
+            for key, blocked in rows:
+                found[key] = bool(blocked)
+        return found
+
+    def _store(self, digest, verdicts):
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO classifications (digest, url, blocked) "
+                "VALUES (?, ?, ?)",
+                ((digest, key, blocked) for key, blocked in verdicts.items()),
+            )
+
+    def _classify(self, digest, keys, classify):
+        """Return a list with the verdict on each of `keys`.
+
+        :param classify: function returning the verdicts on a list of keys
+            that are not cached
+        """
+        verdicts = dict()
+        missing = []
+        for key in keys:
+            if key in verdicts:
+                continue
+            try:
+                verdicts[key] = self._lru[key]
+                self._lru.move_to_end(key)
+            except KeyError:
+                verdicts[key] = None
+                missing.append(key)
+
+        if missing:
+            found = self._lookup(digest, missing)
+            unseen = [key for key in missing if key not in found]
+            new = dict(zip(unseen, classify(unseen))) if unseen else dict()
+            for key in missing:
+                blocked = found[key] if key in found else new[key]
+                verdicts[key] = blocked
+                self._remember(key, blocked)
+
+            if new:
+                logger.debug("Classified {} new URLs".format(len(new)))
+                self._store(digest, new)
+
+        return [verdicts[key] for key in keys]
+
+    def classify(self, urls):
+        """Return a list with whether each of `urls` should be blocked."""
+        return self._classify(
+            self.digest,
+            urls,
+            lambda urls: [self.easylist.should_block(url) for url in urls],
+        )
+
+    def classify_requests(self, urls, top_level_urls, types, third_party_flags):
+        """Return a list with whether each request should be blocked.
+
+        Takes the columns of `EasyList.classify_batch`, and honours rule
+        options like it. Verdicts are keyed by the URL, the request type
+        option, the third-party flag and the host of the page, which is all
+        the options depend on.
+        """
+        requests = dict()
+        keys = []
+        for url, top_level_url, content_type, third_party in zip(
+            urls, top_level_urls, types, third_party_flags
+        ):
+            page = urlparse(top_level_url).hostname if top_level_url else None
+            if third_party is not None:
+                third_party = bool(third_party)
+            # URLs never hold a tab, so these never clash with `classify` keys.
+            key = "{}\t{}\t{}\t{}".format(
+                CONTENT_POLICY_TYPES.get(content_type), third_party, page, url
+            )
+            requests.setdefault(key, (url, top_level_url, content_type, third_party))
+            keys.append(key)
+
+        def classify(keys):
+            columns = zip(*(requests[key] for key in keys))
+            return self.easylist.classify_batch(*columns)
+
+        return self._classify(self.requests_digest, keys, classify)
+
+    def should_block(self, url):
+        """Return True if `url` is blocked, consulting the cache first."""
+        return self.classify([url])[0]
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
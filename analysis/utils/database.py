@@ -1,11 +1,97 @@
+"""Queries against the stream database.
+
+The database is reached through cloud_sql_proxy on localhost:6543, and every
+connection through the proxy pays a TCP and authentication handshake. The
+helpers here share a small pool of connections, created on first use, and
+borrow one for each query with `cursor()`.
+
+With STREAMS_REPLICA set to the path of a local replica of the database (see
+`utils.replica`), the helpers read from the replica instead, and need neither
+the proxy nor a password.
+"""
+
+import atexit
+import contextlib
+import functools
 import logging
 import os
 
-import psycopg2
+import psycopg2.pool
 
-GCSQL_PWD = os.environ["GCSQL_PWD"]
+from utils.scanner import connect_readonly
+
+GCSQL_PWD = os.environ.get("GCSQL_PWD")
+STREAMS_REPLICA = os.environ.get("STREAMS_REPLICA")
 logger = logging.getLogger(__name__)
 
+# Connections kept open at most, e.g. for helpers used from several threads
+MAX_CONNECTIONS = 4
+
+_pool = None
+_pool_pid = None
+
+
+def _get_pool():
+    """Return this process's connection pool, creating it if needed."""
+    global _pool, _pool_pid
+    # Connections can't be shared with a forked child.
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = psycopg2.pool.ThreadedConnectionPool(
+            1,
+            MAX_CONNECTIONS,
+            host="localhost",
+            port="6543",
+            dbname="postgres",
+            user="postgres",
+            password=GCSQL_PWD,
+        )
+        _pool_pid = os.getpid()
+    return _pool
+
+
+@contextlib.contextmanager
+def postgres_cursor():
+    """Yield a cursor on a pooled connection to the stream database.
+
+    The transaction is committed when the block exits, or rolled back if it
+    raises, and the connection goes back to the pool.
+    """
+    pool = _get_pool()
+    conn = pool.getconn()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                yield cur
+    finally:
+        pool.putconn(conn)
+
+
+@contextlib.contextmanager
+def cursor():
+    """Yield a cursor on the stream database, or on its replica if configured.
+
+    A replica cursor is read-only and takes SQLite's dialect.
+    """
+    if STREAMS_REPLICA is None:
+        with postgres_cursor() as cur:
+            yield cur
+        return
+
+    conn = connect_readonly(STREAMS_REPLICA)
+    try:
+        yield conn.cursor()
+    finally:
+        conn.close()
+
+
+@atexit.register
+def close_all():
+    """Close the pooled connections of this process."""
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.closeall()
+    _pool = None
+
 
 def get_channel_providers():
     """Return each distinct base_url and its corresponding IP address.
@@ -14,27 +100,23 @@ def get_channel_providers():
 
     :rtype: List of (base_url, ip address)
     """
-    conn = psycopg2.connect(
-        host="localhost",
-        port="6543",
-        dbname="postgres",
-        user="postgres",
-        password=GCSQL_PWD,
-    )
-
-    cur = conn.cursor()
-
     # Only grab the most recent access IP
-    select_cmd = (
-        "SELECT DISTINCT ON (base_url) base_url, ip FROM stream_urls "
-        "ORDER BY base_url, last_access DESC"
-    )
-    cur.execute(select_cmd)
-    result = cur.fetchall()
+    if STREAMS_REPLICA is None:
+        select_cmd = (
+            "SELECT DISTINCT ON (base_url) base_url, ip FROM stream_urls "
+            "ORDER BY base_url, last_access DESC"
+        )
+    else:
+        # SQLite takes the bare columns of the row with the max()
+        select_cmd = (
+            "SELECT base_url, ip FROM (SELECT base_url, ip, max(last_access) "
+            "FROM stream_urls GROUP BY base_url) ORDER BY base_url"
+        )
+    with cursor() as cur:
+        cur.execute(select_cmd)
+        result = cur.fetchall()
     logger.info("Total channel_providers: {}".format(len(result)))
 
-    cur.close()
-    conn.close()
     return result
 
 
@@ -43,46 +125,75 @@ def urls_per_channel_provider():
 
     :rtype: dict
     """
-    conn = psycopg2.connect(
-        host="localhost",
-        port="6543",
-        dbname="postgres",
-        user="postgres",
-        password=GCSQL_PWD,
-    )
-
-    cur = conn.cursor()
-
     # Only grab the most recent access IP
     select_cmd = "SELECT base_url, count(url) FROM stream_urls GROUP BY base_url"
-    cur.execute(select_cmd)
-    rows = cur.fetchall()
+    with cursor() as cur:
+        cur.execute(select_cmd)
+        rows = cur.fetchall()
 
     result = {}
     for base_url, count in rows:
         result[base_url] = count
 
-    cur.close()
-    conn.close()
     return result
 
 
 def total_stream_urls():
-    conn = psycopg2.connect(
-        host="localhost",
-        port="6543",
-        dbname="postgres",
-        user="postgres",
-        password=GCSQL_PWD,
-    )
-
-    cur = conn.cursor()
-
     # Only grab the most recent access IP
     select_cmd = "SELECT count(url) FROM stream_urls"
-    cur.execute(select_cmd)
-    result = cur.fetchone()[0]
+    with cursor() as cur:
+        cur.execute(select_cmd)
+        result = cur.fetchone()[0]
 
-    cur.close()
-    conn.close()
     return result
+
+
+@functools.lru_cache(maxsize=None)
+def _stream_url_sources():
+    """Return where each base_url was linked from, grouped in one query.
+
+    Memoized for the life of the process.
+
+    :rtype: dict of base_url -> list of (aggregator, upvotes, number of
+        stream_urls rows), earliest created first
+    """
+    sources = dict()
+    with cursor() as cur:
+        cur.execute(
+            """
+            SELECT base_url, aggregator, upvotes, count(*)
+            FROM stream_urls
+            GROUP BY base_url, aggregator, upvotes
+            ORDER BY min(created_on), aggregator, upvotes
+            """
+        )
+        for base_url, aggregator, upvotes, count in cur:
+            sources.setdefault(base_url, []).append((aggregator, upvotes, count))
+    logger.info("Stream URL sources of {} base_urls".format(len(sources)))
+
+    return sources
+
+
+def get_aggregators(base_url):
+    """Return the distinct aggregators linking to `base_url`, earliest first.
+
+    The first one is the aggregator of the CP's earliest created stream URL.
+
+    :rtype: list
+    """
+    sources = _stream_url_sources().get(base_url, ())
+    return list(dict.fromkeys(aggregator for aggregator, _, _ in sources))
+
+
+def get_reddit_upvotes(base_url):
+    """Return the upvotes of each reddit post linking to `base_url`.
+
+    :rtype: list
+    """
+    sources = _stream_url_sources().get(base_url, ())
+    return [
+        upvotes
+        for aggregator, upvotes, count in sources
+        if aggregator == "reddit"
+        for _ in range(count)
+    ]
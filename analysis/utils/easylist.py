@@ -1,21 +1,608 @@
 """Utilities for checking if a URL is on a blocklist."""
 
+import hashlib
+import json
+import logging
+import mmap
 import os
+import re
+import shutil
+import struct
+import tempfile
+from urllib.parse import urlparse
 
-from adblockparser import AdblockRules
+from adblockparser import AdblockRule
+
+logger = logging.getLogger(__name__)
+
+LIST_PATH = os.path.dirname(os.path.realpath(__file__)) + "/easyprivacy.txt"
+
+# Compiled artifacts start with the magic and the length of a JSON header
+# mapping each keyword to the span of its regex source in the blob after it.
+# Bump the version whenever the layout or the keyword selection changes.
+ARTIFACT_MAGIC = b"EASYLIST"
+ARTIFACT_HEADER = struct.Struct("<8sI")
+ARTIFACT_VERSION = 2
+
+# Request type option for each external nsIContentPolicy type, as recorded in
+# http_requests.content_policy_type. Types without an option of their own are
+# mapped the way Adblock Plus maps them.
+CONTENT_POLICY_TYPES = {
+    1: "other",
+    2: "script",
+    3: "image",
+    4: "stylesheet",
+    5: "object",
+    6: "document",
+    7: "subdocument",
+    8: "other",  # refresh
+    9: "xbl",
+    10: "ping",
+    11: "xmlhttprequest",
+    12: "object-subrequest",
+    13: "dtd",
+    14: "other",  # font
+    15: "media",
+    16: "websocket",
+    17: "other",  # CSP report
+    18: "other",  # XSLT
+    19: "ping",  # beacon
+    20: "xmlhttprequest",  # fetch
+    21: "image",  # imageset
+    22: "other",  # web manifest
+}
+TYPE_OPTIONS = frozenset(CONTENT_POLICY_TYPES.values())
+
+# Options we can evaluate from a request; rules using any other are skipped.
+SUPPORTED_OPTIONS = TYPE_OPTIONS | {"third-party", "domain", "match-case"}
+
+# A token is a maximal run of these characters in a lowercased URL. Rule
+# keywords are chosen so that they always appear as a whole token in any URL
+# the rule can match.
+TOKEN_RE = re.compile(r"[a-z0-9%]+")
+
+# Tokens shorter than this make poor keywords since nearly every URL has them.
+MIN_KEYWORD_LEN = 3
+
+
+def _rule_keywords(rule_text):
+    """Return the tokens of `rule_text` usable as an index keyword.
+
+    A token qualifies only if it is bounded on both sides by a literal
+    non-token character, a separator (``^``) or an anchor (``|``/``||``), so
+    that a matching URL is guaranteed to contain it as a whole token.
+    """
+    if rule_text.startswith("/") and rule_text.endswith("/"):
+        # Raw regular expression, nothing to extract safely.
+        return []
+
+    # adblockparser rewrites any `|` that is not a leading or trailing anchor
+    # in a way that swallows the following character, so leave those alone.
+    inner = rule_text.lstrip("|")
+    if inner.endswith("|"):
+        inner = inner[:-1]
+    if "|" in inner:
+        return []
+
+    text = rule_text.lower()
+    keywords = []
+    for match in TOKEN_RE.finditer(text):
+        start, end = match.span()
+        if start == 0 or text[start - 1] == "*":
+            continue
+        if end == len(text) or text[end] == "*":
+            continue
+        keywords.append(match.group())
+    return keywords
+
+
+class TokenIndex:
+    """Rules bucketed by a keyword so a URL only tries a handful of them.
+
+    Each rule is filed under one keyword it contains (the least used so far).
+    Rules without a usable keyword go in the unindexed bucket, which is tried
+    for every URL. Buckets are compiled into a single regex on first use.
+
+    An index can be written out with `dump` and mapped back with
+    `from_buffer`. A mapped index is read only and pulls the regex source of
+    a bucket out of the buffer the first time the bucket is needed.
+    """
+
+    def __init__(self, rules=()):
+        self._buckets = dict()
+        self._compiled = dict()
+        self._buf = None
+        for rule in rules:
+            self.add(rule)
+
+    def __len__(self):
+        return sum(self._count(keyword) for keyword in self._buckets)
+
+    def _count(self, keyword):
+        """Return the number of rules filed under `keyword`."""
+        if self._buf is not None:
+            return self._buckets[keyword][3]
+        return len(self._buckets[keyword])
+
+    def add(self, rule, match_case=None):
+        """File `rule` (an AdblockRule) under its best keyword.
+
+        By default rules with any options are matched case sensitively, as
+        adblockparser does.
+        """
+        if self._buf is not None:
+            raise RuntimeError("Cannot add rules to a mapped index")
+
+        keywords = _rule_keywords(rule.rule_text)
+        if keywords:
+            keyword = min(
+                keywords,
+                key=lambda k: (
+                    len(k) < MIN_KEYWORD_LEN,
+                    len(self._buckets.get(k, ())),
+                    -len(k),
+                ),
+            )
+        else:
+            keyword = ""
+
+        if match_case is None:
+            match_case = bool(rule.options)
+        # A rule with options only (e.g. "$third-party") matches any URL.
+        regex = rule.regex or "(?:)"
+        self._buckets.setdefault(keyword, []).append((regex, match_case))
+        self._compiled.pop(keyword, None)
+
+    def _sources(self, keyword):
+        """Return the (case insensitive, case sensitive) sources of a bucket."""
+        bucket = self._buckets[keyword]
+        if self._buf is not None:
+            offset, icase_len, case_len, _ = bucket
+            icase_end = offset + icase_len
+            return (
+                str(self._buf[offset:icase_end], "utf-8"),
+                str(self._buf[icase_end : icase_end + case_len], "utf-8"),
+            )
+
+        return (
+            "|".join(regex for regex, case in bucket if not case),
+            "|".join(regex for regex, case in bucket if case),
+        )
+
+    def _compile(self, keyword):
+        """Return the (case insensitive, case sensitive) regexes of a bucket."""
+        try:
+            return self._compiled[keyword]
+        except KeyError:
+            pass
+
+        icase, case = self._sources(keyword)
+        compiled = (
+            re.compile(icase, re.IGNORECASE) if icase else None,
+            re.compile(case) if case else None,
+        )
+        self._compiled[keyword] = compiled
+        return compiled
+
+    def _bucket_matches(self, keyword, url):
+        return any(
+            regex is not None and regex.search(url)
+            for regex in self._compile(keyword)
+        )
+
+    def matches(self, url):
+        """Return True if any rule in the index matches `url`."""
+        if url.isascii():
+            keywords = self._buckets.keys() & set(TOKEN_RE.findall(url.lower()))
+            if "" in self._buckets:
+                keywords.add("")
+        else:
+            # Case folding of non-ASCII text does not line up with the
+            # tokenizer, so check every bucket.
+            keywords = self._buckets.keys()
+
+        return any(self._bucket_matches(keyword, url) for keyword in keywords)
+
+    def dump(self, fp):
+        """Write the bucket sources to `fp` at its current position.
+
+        :rtype: dict of keyword -> (offset, icase length, case length, rules)
+        """
+        spans = dict()
+        offset = fp.tell()
+        for keyword in self._buckets:
+            icase, case = (s.encode("utf-8") for s in self._sources(keyword))
+            fp.write(icase)
+            fp.write(case)
+            spans[keyword] = (
+                offset,
+                len(icase),
+                len(case),
+                self._count(keyword),
+            )
+            offset += len(icase) + len(case)
+        return spans
+
+    @classmethod
+    def from_buffer(cls, spans, buf):
+        """Return a read only index over `buf` as laid out by `dump`."""
+        index = cls()
+        index._buckets = {keyword: tuple(span) for keyword, span in spans.items()}
+        index._buf = buf
+        return index
+
+
+def _domain_variants(domain):
+    """Return `domain` and its parent domains, most specific first."""
+    parts = domain.split(".")
+    if len(parts) == 1:
+        return (domain,)
+    return tuple(".".join(parts[i:]) for i in range(len(parts) - 1))
+
+
+def _page_domains(top_level_url):
+    """Return the domain variants of the page a request was made from."""
+    if not top_level_url:
+        return None
+    hostname = urlparse(top_level_url).hostname
+    if not hostname:
+        return None
+    return _domain_variants(hostname)
+
+
+def _rule_types(options):
+    """Return the request types a rule applies to, or None for all types."""
+    include = {k for k, v in options.items() if k in TYPE_OPTIONS and v}
+    exclude = {k for k, v in options.items() if k in TYPE_OPTIONS and not v}
+    if include:
+        return frozenset(include - exclude)
+    if exclude:
+        return TYPE_OPTIONS - exclude
+    return None
+
+
+class DomainRule:
+    """A rule restricted to (or away from) pages on certain domains.
+
+    There are few enough of these that they are matched one by one, after
+    looking them up by the page domain.
+    """
+
+    __slots__ = ["regex", "match_case", "types", "third_party", "domains", "_re"]
+
+    def __init__(self, regex, match_case, types, third_party, domains):
+        self.regex = regex
+        self.match_case = match_case
+        self.types = types
+        self.third_party = third_party
+        self.domains = domains
+        self._re = None
+
+    @classmethod
+    def from_rule(cls, rule):
+        """Return a DomainRule for `rule` (an AdblockRule)."""
+        return cls(
+            rule.regex,
+            rule.options.get("match-case", False),
+            _rule_types(rule.options),
+            rule.options.get("third-party"),
+            rule.options["domain"],
+        )
+
+    def to_json(self):
+        types = sorted(self.types) if self.types is not None else None
+        return [self.regex, self.match_case, types, self.third_party, self.domains]
+
+    @classmethod
+    def from_json(cls, value):
+        regex, match_case, types, third_party, domains = value
+        types = frozenset(types) if types is not None else None
+        return cls(regex, match_case, types, third_party, domains)
+
+    def applies(self, content_type, third_party, domains):
+        """Return True if the rule covers a request with these options."""
+        if self.types is not None and content_type not in self.types:
+            return False
+        if self.third_party is not None and third_party != self.third_party:
+            return False
+        for domain in domains:
+            if domain in self.domains:
+                return self.domains[domain]
+        return not any(self.domains.values())
+
+    def matches(self, url):
+        if self._re is None:
+            self._re = re.compile(
+                self.regex, 0 if self.match_case else re.IGNORECASE
+            )
+        return bool(self._re.search(url))
+
+
+class RuleSet:
+    """The blocking or the exception rules of a list, partitioned by options.
+
+    Rules are filed into a TokenIndex per (request type, third-party) cell,
+    where None stands for "any": rules without options live in the
+    (None, None) cell, a `$third-party` rule in (None, True), a `$script`
+    rule in ("script", None), and a rule listing several types in the cell of
+    each of them. A request then only checks the (at most) four cells that can
+    apply to it. Rules restricted by page domain are looked up by domain
+    instead.
+    """
+
+    def __init__(self):
+        self.partitions = {(None, None): TokenIndex()}
+        self.domain_rules = dict()
+        self.exclusion_rules = []
+
+    def __len__(self):
+        rules = set(map(id, self.exclusion_rules))
+        for domain_rules in self.domain_rules.values():
+            rules.update(map(id, domain_rules))
+        return sum(map(len, self.partitions.values())) + len(rules)
+
+    @property
+    def generic(self):
+        """The index of rules without options."""
+        return self.partitions[(None, None)]
+
+    def add(self, rule):
+        """File `rule` (an AdblockRule) by its options."""
+        if not rule.options or set(rule.options) == {"match-case"}:
+            self.generic.add(rule)
+            return
+
+        if not SUPPORTED_OPTIONS.issuperset(rule.options):
+            return
+
+        if "domain" in rule.options:
+            self._add_domain_rule(DomainRule.from_rule(rule))
+            return
+
+        types = _rule_types(rule.options)
+        third_party = rule.options.get("third-party")
+        for content_type in types if types is not None else (None,):
+            cell = (content_type, third_party)
+            if cell not in self.partitions:
+                self.partitions[cell] = TokenIndex()
+            self.partitions[cell].add(
+                rule, match_case=rule.options.get("match-case", False)
+            )
+
+    def _add_domain_rule(self, rule):
+        required = [domain for domain, include in rule.domains.items() if include]
+        if not required:
+            self.exclusion_rules.append(rule)
+        for domain in required:
+            self.domain_rules.setdefault(domain, []).append(rule)
+
+    def matches(self, url):
+        """Return True if a rule without options matches `url`."""
+        return self.generic.matches(url)
+
+    def matches_request(self, url, content_type, third_party, domains):
+        """Return True if a rule applicable to the request matches `url`.
+
+        :param content_type: request type option (e.g. "script") or None
+        :param third_party: whether the request is third-party, or None
+        :param domains: domain variants of the page, or None
+        """
+        cells = [(None, None)]
+        if third_party is not None:
+            cells.append((None, third_party))
+        if content_type is not None:
+            cells.append((content_type, None))
+            if third_party is not None:
+                cells.append((content_type, third_party))
+
+        for cell in cells:
+            index = self.partitions.get(cell)
+            if index is not None and index.matches(url):
+                return True
+
+        if domains is None:
+            return False
+
+        candidates = list(self.exclusion_rules)
+        for domain in domains:
+            candidates.extend(self.domain_rules.get(domain, ()))
+        return any(
+            rule.matches(url)
+            for rule in candidates
+            if rule.applies(content_type, third_party, domains)
+        )
+
+    def dump(self, fp):
+        """Write the partitions to `fp` and return a JSON-able layout."""
+        rules = dict()
+        for rule in self.exclusion_rules:
+            rules[id(rule)] = rule
+        for domain_rules in self.domain_rules.values():
+            for rule in domain_rules:
+                rules[id(rule)] = rule
+
+        return dict(
+            partitions=[
+                [content_type, third_party, index.dump(fp)]
+                for (content_type, third_party), index in self.partitions.items()
+            ],
+            domain_rules=[rule.to_json() for rule in rules.values()],
+        )
+
+    @classmethod
+    def from_buffer(cls, layout, buf):
+        """Return a read only rule set over `buf` as laid out by `dump`."""
+        rule_set = cls()
+        for content_type, third_party, spans in layout["partitions"]:
+            rule_set.partitions[(content_type, third_party)] = TokenIndex.from_buffer(
+                spans, buf
+            )
+        for value in layout["domain_rules"]:
+            rule_set._add_domain_rule(DomainRule.from_json(value))
+        return rule_set
+
+
+def list_digest(path=LIST_PATH):
+    """Return the SHA-256 hex digest of the list file at `path`."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def artifact_path(path=LIST_PATH, digest=None):
+    """Return where the compiled artifact of the list at `path` lives."""
+    if digest is None:
+        digest = list_digest(path)
+    root, _ = os.path.splitext(path)
+    return "{}.{}.idx".format(root, digest[:16])
 
 
 class EasyList:
+    """EasyPrivacy rules, compiled once into an on-disk artifact.
+
+    The artifact is named after a hash of the list file and is memory mapped
+    when loaded, so processes (e.g. ProcessPoolExecutor workers) share one
+    read only copy through the page cache instead of each parsing the list.
+    """
+
     def _read_raw_rules(self):
         """Read in the EasyList and EasyPrivacy."""
-        path = os.path.dirname(os.path.realpath(__file__)) + "/easyprivacy.txt"
-
-        with open(path) as f:
+        with open(self.path) as f:
             raw_lines = f.read().splitlines()
 
-            rules = AdblockRules(raw_lines)
+            return [AdblockRule(line) for line in raw_lines]
 
-            return rules
+    def __init__(self, path=LIST_PATH):
+        self.path = path
+        self.digest = list_digest(path)
 
-    def __init__(self):
-        self.rules = self._read_raw_rules()
+        artifact = artifact_path(path, self.digest)
+        try:
+            self._load(artifact)
+        except (FileNotFoundError, ValueError, struct.error):
+            logger.info("Compiling {} into {}".format(path, artifact))
+            self._compile()
+            try:
+                self.save(artifact)
+            except OSError:
+                logger.warning("Unable to save {}".format(artifact))
+
+    def _compile(self):
+        """Parse the list and index its rules."""
+        self.blacklist = RuleSet()
+        self.whitelist = RuleSet()
+
+        for rule in self._read_raw_rules():
+            # Mirror AdblockRules: skip comments and element hiding rules.
+            if rule.is_comment or rule.is_html_rule:
+                continue
+            if not (rule.regex or rule.options):
+                continue
+
+            if rule.is_exception:
+                self.whitelist.add(rule)
+            else:
+                self.blacklist.add(rule)
+
+    def _load(self, artifact):
+        """Map a compiled artifact, raising ValueError if it is stale."""
+        with open(artifact, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, header_len = ARTIFACT_HEADER.unpack_from(buf)
+            if magic != ARTIFACT_MAGIC:
+                raise ValueError("{} is not an EasyList artifact".format(artifact))
+
+            start = ARTIFACT_HEADER.size
+            header = json.loads(buf[start : start + header_len].decode("utf-8"))
+            if header["version"] != ARTIFACT_VERSION or header["digest"] != self.digest:
+                raise ValueError("{} is out of date".format(artifact))
+        except BaseException:
+            # The caller recompiles; don't keep the rejected file mapped.
+            buf.close()
+            raise
+
+        # Bucket sources are sliced out of the mapping lazily, without copying
+        # the rest of the file.
+        blob = memoryview(buf)[start + header_len :]
+        self.blacklist = RuleSet.from_buffer(header["blacklist"], blob)
+        self.whitelist = RuleSet.from_buffer(header["whitelist"], blob)
+
+    def save(self, artifact):
+        """Write the compiled rules to `artifact`.
+
+        The file is written next to its final location and then renamed, so
+        concurrent readers never see a partial artifact.
+        """
+        with tempfile.TemporaryFile() as blob:
+            header = dict(
+                version=ARTIFACT_VERSION,
+                digest=self.digest,
+                blacklist=self.blacklist.dump(blob),
+                whitelist=self.whitelist.dump(blob),
+            )
+            header = json.dumps(header).encode("utf-8")
+
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(artifact))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(ARTIFACT_HEADER.pack(ARTIFACT_MAGIC, len(header)))
+                    f.write(header)
+                    blob.seek(0)
+                    shutil.copyfileobj(blob, f)
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, artifact)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+    def should_block(self, url):
+        """Return True if `url` is blocked by the list.
+
+        Gives the same answer as ``AdblockRules.should_block(url)`` with no
+        options.
+        """
+        if self.whitelist.matches(url):
+            return False
+        return self.blacklist.matches(url)
+
+    def classify_batch(self, urls, top_level_urls, types, third_party_flags):
+        """Return whether each request should be blocked, honouring options.
+
+        The arguments are parallel columns, e.g. the url, top_level_url,
+        content_policy_type and is_third_party_channel columns of
+        http_requests. Rules depending on a value that is None are left out,
+        as adblockparser does with options it is not given. Otherwise options
+        follow Adblock Plus rather than adblockparser: a rule listing several
+        request types applies to any of them, and only `$match-case` rules
+        are matched case sensitively.
+
+        :rtype: list of bool
+        """
+        page_domains = dict()
+        results = []
+        for url, top_level_url, content_type, third_party in zip(
+            urls, top_level_urls, types, third_party_flags
+        ):
+            try:
+                domains = page_domains[top_level_url]
+            except KeyError:
+                domains = page_domains[top_level_url] = _page_domains(top_level_url)
+
+            request = (
+                url,
+                CONTENT_POLICY_TYPES.get(content_type),
+                bool(third_party) if third_party is not None else None,
+                domains,
+            )
+            results.append(
+                not self.whitelist.matches_request(*request)
+                and self.blacklist.matches_request(*request)
+            )
+        return results
+
+
+if __name__ == "__main__":
+    # Build step: compile the list ahead of time so analysis runs only map it.
+    easylist = EasyList()
+    print(artifact_path(easylist.path, easylist.digest))
@@ -0,0 +1,159 @@
+"""Concurrent lookups of remote services, cached on disk.
+
+An `Enricher` looks keys (an IP, a domain) up with a set of `Service`s from a
+pool of threads. Each service has its own rate limit, shared by the threads,
+and its results are kept in an SQLite database for as long as the service's
+TTL, so reruns only query the keys they have not seen recently. Services are
+plain functions, so they can be pointed at local stub servers.
+"""
+
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# Lookups in flight at most
+MAX_WORKERS = 8
+
+Service = collections.namedtuple("Service", ["lookup", "ttl", "rate"])
+Service.__doc__ = """A remote lookup run by `Enricher`.
+
+:ivar lookup: function of a key returning a JSON-able result. Exceptions are
+    raised to the caller and nothing is cached.
+:ivar ttl: seconds a cached result stays valid
+:ivar rate: lookups per second at most, or None for no limit
+"""
+
+
+class RateLimiter:
+    """Space out the calls of several threads to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        """Block until the next call is allowed."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class LookupCache:
+    """Results of lookups by (service, key), stored with when they were made.
+
+    The connection is opened lazily in each process and shared by its
+    threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Return this process's connection to the cache database."""
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+
+        conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS lookups (
+                service TEXT NOT NULL,
+                key TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (service, key)
+            ) WITHOUT ROWID
+            """
+        )
+        conn.commit()
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def get(self, service, key, ttl):
+        """Return (True, result) if a lookup newer than `ttl` is cached.
+
+        Returns (False, None) otherwise.
+        """
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT value FROM lookups "
+                    "WHERE service = ? AND key = ? AND fetched_at >= ?",
+                    (service, key, time.time() - ttl),
+                )
+                .fetchone()
+            )
+        if row is None:
+            return (False, None)
+        return (True, json.loads(row[0]))
+
+    def put(self, service, key, result):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?)",
+                    (service, key, time.time(), json.dumps(result)),
+                )
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+class Enricher:
+    """Run cached, rate limited lookups from a pool of threads.
+
+    :param services: dict of name -> Service
+    :param cache_path: SQLite database keeping the results
+    :param workers: number of threads, which bounds the lookups in flight
+    """
+
+    def __init__(self, services, cache_path, workers=MAX_WORKERS):
+        self.services = services
+        self.cache = LookupCache(cache_path)
+        self.workers = workers
+        self._limiters = {
+            name: RateLimiter(service.rate) for name, service in services.items()
+        }
+
+    def lookup(self, name, key):
+        """Return the result of service `name` for `key`, cached if possible."""
+        service = self.services[name]
+        hit, result = self.cache.get(name, key, service.ttl)
+        if hit:
+            return result
+
+        self._limiters[name].wait()
+        result = service.lookup(key)
+        self.cache.put(name, key, result)
+        return result
+
+    def map(self, func, items):
+        """Return [func(*item) for item in items], computed by the threads.
+
+        `func` makes its lookups with `lookup`.
+        """
+        items = list(items)
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            return list(tqdm(executor.map(lambda i: func(*i), items), total=len(items)))
@@ -0,0 +1,44 @@
+"""Declarative heuristics over aggregated features of crawl rows.
+
+A heuristic is a dict of named `Feature`s, each an SQL expression evaluated on
+every row it looks at and an aggregation of its values, plus a rule over the
+table of aggregates. `aggregate` computes the features of a batch of rows with
+a pandas groupby. Since every aggregation can be combined from partial ones,
+features aggregated over small groups (e.g. the calls of one script in one
+visit) and stored in SQLite roll up to larger groups with a GROUP BY using
+`ROLLUP`.
+"""
+
+import collections
+
+import pandas as pd
+
+# SQL aggregate combining the partial aggregates of a group. total() is like
+# sum() but is 0 rather than NULL over no values, like pandas.
+ROLLUP = {"sum": "total", "count": "total", "max": "max", "min": "min"}
+
+Feature = collections.namedtuple("Feature", ["expression", "how"])
+Feature.__doc__ = """An aggregate of an SQL expression over crawl rows.
+
+:ivar expression: SQL expression over the columns of the table scanned. NULL
+    values are ignored by the aggregation.
+:ivar how: "sum", "count", "max" or "min". Use "max" over a boolean expression
+    for "any row"; it is NaN for groups where the expression is always NULL.
+"""
+
+
+def aggregate(features, rows, by):
+    """Return the DataFrame of `features` aggregated over `rows`.
+
+    :param features: dict of name -> Feature
+    :param rows: sequences of the values of the `by` columns, then of the
+        features in `features` order
+    :param by: names of the columns to group by, which index the result
+    """
+    names = list(features)
+    frame = pd.DataFrame.from_records(rows, columns=list(by) + names)
+    # SQL NULLs come in as None
+    frame[names] = frame[names].astype(float)
+    return frame.groupby(list(by), dropna=False).agg(
+        {name: feature.how for name, feature in features.items()}
+    )
@@ -0,0 +1,158 @@
+"""Memoize analysis stages on the inputs they were computed from.
+
+A stage's key hashes its version, a fingerprint of the crawl database it
+reads and the digests of any list files it uses. The key is stored next to
+the cached result in ``<cache>.key``, together with a hash of the cache file.
+When the key no longer matches, the cache is recomputed and overwritten, so
+stale results are evicted as soon as their stage runs again. Bump a stage's
+version whenever its detection or aggregation code changes.
+
+Caches written before keys existed have no sidecar and are recomputed once
+to get one. Caches whose inputs are not available (e.g. there is no crawl
+database) are used as is.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+def _sidecar(path):
+    return path + ".key"
+
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of the file at `path`."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def db_fingerprint(path):
+    """Return a cheap fingerprint of the SQLite database at `path`.
+
+    Crawl databases are only ever appended to, so the highest rowid of each
+    table identifies their contents without reading them.
+    """
+    conn = sqlite3.connect(path)
+    tables = [
+        name
+        for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name;"
+        )
+    ]
+    fingerprint = {
+        table: conn.execute('SELECT max(rowid) FROM "{}";'.format(table)).fetchone()[0]
+        for table in tables
+    }
+    conn.close()
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def stage_key(version, db=None, files=()):
+    """Return the key of a stage computed from the given inputs.
+
+    Returns None if one of the inputs does not exist.
+
+    :param version: version of the stage's code
+    :param db: path to the SQLite database the stage reads, if any
+    :param files: paths to other files the stage reads, e.g. EasyList
+    """
+    inputs = {"version": version}
+    try:
+        if db is not None:
+            if not os.path.exists(db):
+                return None
+            inputs["db"] = db_fingerprint(db)
+        inputs["files"] = [file_digest(path) for path in files]
+    except FileNotFoundError:
+        return None
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def read_key(path):
+    """Return the key recorded for the cache at `path`, or None."""
+    try:
+        with open(_sidecar(path)) as f:
+            sidecar = json.load(f)
+        digest = file_digest(path)
+    except FileNotFoundError:
+        return None
+
+    if sidecar["sha256"] != digest:
+        logger.warning("{} changed since its key was written".format(path))
+        return None
+    return sidecar["key"]
+
+
+def write_key(path, key):
+    """Record that the cache at `path` was computed from inputs with `key`."""
+    sidecar = {"key": key, "sha256": file_digest(path)}
+    tmp = _sidecar(path) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(sidecar, f)
+    os.replace(tmp, _sidecar(path))
+
+
+def _load(path):
+    try:
+        if path.endswith(".json"):
+            with open(path) as f:
+                return json.load(f)
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _dump(path, result):
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(result, f)
+    else:
+        with open(path, "wb") as f:
+            pickle.dump(result, f)
+
+
+def memoize(path, version, db=None, files=()):
+    """Cache the result of a stage at `path` until its inputs change.
+
+    Results are stored as JSON if `path` ends in ``.json`` and pickled
+    otherwise. The decorated function's arguments are not part of the key.
+    See `stage_key` for the other parameters.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = stage_key(version, db, files)
+            cached = _load(path)
+            if cached is not None:
+                if key is None:
+                    return cached
+                stored = read_key(path)
+                if stored == key:
+                    return cached
+                if stored is None:
+                    logger.info("{} has no key, recomputing".format(path))
+                else:
+                    logger.info("{} is stale, recomputing".format(path))
+
+            result = func(*args, **kwargs)
+            _dump(path, result)
+            if key is not None:
+                write_key(path, key)
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,188 @@
+"""Site ranks from a downloaded top sites list, e.g. the Tranco top 1M.
+
+The list is a CSV of ``rank,domain`` lines, such as the ``top-1m.csv`` of
+https://tranco-list.eu, saved as `LIST_PATH`. It is compiled once into an
+index named after a hash of the list, ``<list>.<digest>.ranks``: the 64-bit
+hashes of its domains, sorted, followed by their ranks. The index is memory
+mapped when loaded, and `RankIndex.ranks` looks up any number of domains
+with a single binary search over it.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from utils.memoize import file_digest
+
+logger = logging.getLogger(__name__)
+
+LIST_PATH = os.path.dirname(os.path.realpath(__file__)) + "/top-1m.csv"
+
+# Rank of the domains not on the list, just past the last bin of the plots
+UNRANKED = 1100000
+
+RANKS_MAGIC = b"TOPRANKS"
+RANKS_HEADER = struct.Struct("<8sI")
+RANKS_VERSION = 1
+
+
+def _hash(domain):
+    """Return the 64-bit hash under which `domain` is indexed."""
+    digest = hashlib.blake2b(domain.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _domain_variants(host):
+    """Return `host` and its parent domains, most specific first.
+
+    Lists rank registrable domains, so the most specific variant on the list
+    is the site's registrable domain.
+    """
+    parts = host.split(".")
+    return [".".join(parts[i:]) for i in range(max(len(parts) - 1, 1))]
+
+
+def _host(domain):
+    """Return the lowercased host of a domain or base_url, without a port."""
+    return domain.lower().split(":")[0].rstrip(".")
+
+
+def index_path(path=LIST_PATH, digest=None):
+    """Return where the index of the list at `path` lives."""
+    if digest is None:
+        digest = file_digest(path)
+    root, _ = os.path.splitext(path)
+    return "{}.{}.ranks".format(root, digest[:16])
+
+
+class RankIndex:
+    """Ranks of the domains of a top sites list, indexed on disk.
+
+    :ivar hashes: sorted hashes of the domains on the list
+    :ivar domain_ranks: rank of each domain in `hashes`, the best if listed twice
+    """
+
+    def __init__(self, path=LIST_PATH):
+        self.path = path
+        self.digest = file_digest(path)
+
+        index = index_path(path, self.digest)
+        try:
+            self._load(index)
+        except (FileNotFoundError, ValueError, struct.error):
+            logger.info("Indexing {} into {}".format(path, index))
+            self._compile()
+            try:
+                self.save(index)
+            except OSError:
+                logger.warning("Unable to save {}".format(index))
+
+    def _compile(self):
+        """Parse the list and sort its domains by hash."""
+        hashes = []
+        ranks = []
+        with open(self.path) as f:
+            for line in f:
+                rank, _, domain = line.strip().partition(",")
+                if not rank.isdigit() or not domain:
+                    continue
+                hashes.append(_hash(_host(domain)))
+                ranks.append(int(rank))
+
+        hashes = np.array(hashes, dtype=np.uint64)
+        ranks = np.array(ranks, dtype=np.uint32)
+        order = np.lexsort((ranks, hashes))
+        hashes, ranks = hashes[order], ranks[order]
+        first = np.ones(len(hashes), dtype=np.bool_)
+        first[1:] = hashes[1:] != hashes[:-1]
+        self.hashes = hashes[first]
+        self.domain_ranks = ranks[first]
+
+    def _load(self, index):
+        """Map an index, raising ValueError if it is stale."""
+        with open(index, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, header_len = RANKS_HEADER.unpack_from(buf)
+            if magic != RANKS_MAGIC:
+                raise ValueError("{} is not a rank index".format(index))
+
+            start = RANKS_HEADER.size
+            header = json.loads(buf[start : start + header_len].decode("utf-8"))
+            if header["version"] != RANKS_VERSION or header["digest"] != self.digest:
+                raise ValueError("{} is out of date".format(index))
+        except BaseException:
+            # The caller recompiles; don't keep the rejected file mapped.
+            buf.close()
+            raise
+
+        start += header_len
+        length = header["length"]
+        self.hashes = np.frombuffer(buf, dtype="<u8", count=length, offset=start)
+        self.domain_ranks = np.frombuffer(
+            buf, dtype="<u4", count=length, offset=start + 8 * length
+        )
+
+    def save(self, index):
+        """Write the index to `index`, atomically."""
+        header = dict(version=RANKS_VERSION, digest=self.digest, length=len(self))
+        header = json.dumps(header).encode("utf-8")
+        # Pad the header so the hashes that follow stay aligned.
+        header += b" " * (-(RANKS_HEADER.size + len(header)) % 8)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(index) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(RANKS_HEADER.pack(RANKS_MAGIC, len(header)))
+                f.write(header)
+                f.write(self.hashes.astype("<u8").tobytes())
+                f.write(self.domain_ranks.astype("<u4").tobytes())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, index)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def ranks(self, domains):
+        """Return the rank of each of `domains`, or UNRANKED if not listed.
+
+        A domain (or base_url) is ranked as its most specific parent domain
+        on the list.
+
+        :rtype: numpy array of int64
+        """
+        owners = []
+        variants = []
+        for i, domain in enumerate(domains):
+            for variant in _domain_variants(_host(domain)):
+                owners.append(i)
+                variants.append(_hash(variant))
+        owners = np.array(owners, dtype=np.int64)
+        variants = np.array(variants, dtype=np.uint64)
+
+        result = np.full(len(domains), UNRANKED, dtype=np.int64)
+        if not len(self) or not len(variants):
+            return result
+
+        found = np.searchsorted(self.hashes, variants)
+        found[found == len(self)] = 0
+        listed = self.hashes[found] == variants
+        # Variants are most specific first, so keep the first listed one of
+        # each domain.
+        owners, first = np.unique(owners[listed], return_index=True)
+        result[owners] = self.domain_ranks[found[listed][first]]
+        return result
+
+    def rank(self, domain):
+        """Return the rank of `domain`, or UNRANKED if not listed."""
+        return int(self.ranks([domain])[0])
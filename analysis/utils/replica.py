@@ -0,0 +1,132 @@
+"""Local SQLite replica of the stream database.
+
+`sync` mirrors the stream_urls and last_inspect tables into a SQLite file.
+Each sync only fetches the stream_urls rows accessed since the previous one,
+and copies last_inspect, a row per inspector, whole. Point STREAMS_REPLICA at
+the file to have `utils.database`, and the collection's utils, use it instead
+of Postgres.
+
+Timestamps are stored as UTC seconds since the epoch, in columns declared
+EPOCH, which the collection's utils convert back to datetimes.
+"""
+
+import calendar
+import datetime
+import logging
+import sqlite3
+
+from utils.database import postgres_cursor
+
+logger = logging.getLogger(__name__)
+
+# Where sync_replica.py keeps the replica by default
+REPLICA_PATH = "cache/streams.sqlite"
+
+# Rows fetched from Postgres and written to the replica at once
+BATCH_ROWS = 10000
+
+STREAM_URLS_COLUMNS = (
+    "url",
+    "base_url",
+    "ip",
+    "aggregator",
+    "upvotes",
+    "created_on",
+    "last_access",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stream_urls (
+    url TEXT PRIMARY KEY,
+    base_url TEXT,
+    ip TEXT,
+    aggregator TEXT,
+    upvotes INTEGER,
+    created_on EPOCH,
+    last_access EPOCH
+);
+CREATE INDEX IF NOT EXISTS stream_urls_base_url ON stream_urls (base_url);
+CREATE INDEX IF NOT EXISTS stream_urls_last_access ON stream_urls (last_access);
+CREATE TABLE IF NOT EXISTS last_inspect (
+    inspector TEXT PRIMARY KEY,
+    scanned EPOCH
+);
+CREATE TABLE IF NOT EXISTS meta (last_access TEXT);
+"""
+
+
+def _epoch(timestamp):
+    """Return a datetime from Postgres as UTC seconds; naive ones are UTC."""
+    if timestamp is None:
+        return None
+    return calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1e6
+
+
+def sync(path=REPLICA_PATH):
+    """Bring the replica at `path` up to date, creating it if needed.
+
+    Rows are upserted by url, so rows accessed again since the previous sync
+    are updated in place. The replica is updated in a single transaction.
+
+    :return: number of stream_urls rows fetched
+    """
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    row = conn.execute("SELECT last_access FROM meta;").fetchone()
+    # The exact Postgres value, so the next sync starts right where this one
+    # ended. Rows accessed at that very time are fetched again.
+    since = datetime.datetime.fromisoformat(row[0]) if row else None
+
+    columns = ", ".join(STREAM_URLS_COLUMNS)
+    select_cmd = "SELECT {} FROM stream_urls".format(columns)
+    if since is not None:
+        select_cmd += " WHERE last_access >= %s"
+    upsert_cmd = (
+        "INSERT INTO stream_urls ({columns}) VALUES ({params}) "
+        "ON CONFLICT (url) DO UPDATE SET {updates};"
+    ).format(
+        columns=columns,
+        params=", ".join("?" for _ in STREAM_URLS_COLUMNS),
+        updates=", ".join(
+            "{0} = excluded.{0}".format(c) for c in STREAM_URLS_COLUMNS[1:]
+        ),
+    )
+
+    fetched = 0
+    latest = since
+    with postgres_cursor() as cur:
+        cur.execute(select_cmd, (since,) if since is not None else None)
+        conn.execute("BEGIN;")
+        try:
+            while True:
+                rows = cur.fetchmany(BATCH_ROWS)
+                if not rows:
+                    break
+                fetched += len(rows)
+                for row in rows:
+                    if row[-1] is not None and (latest is None or row[-1] > latest):
+                        latest = row[-1]
+                conn.executemany(
+                    upsert_cmd,
+                    (row[:-2] + (_epoch(row[-2]), _epoch(row[-1])) for row in rows),
+                )
+
+            cur.execute("SELECT inspector, scanned FROM last_inspect")
+            conn.execute("DELETE FROM last_inspect;")
+            conn.executemany(
+                "INSERT INTO last_inspect VALUES (?, ?);",
+                ((inspector, _epoch(scanned)) for inspector, scanned in cur),
+            )
+
+            if latest is not None:
+                conn.execute("DELETE FROM meta;")
+                conn.execute("INSERT INTO meta VALUES (?);", (latest.isoformat(),))
+            conn.execute("COMMIT;")
+        except BaseException:
+            conn.execute("ROLLBACK;")
+            raise
+        finally:
+            conn.close()
+
+    logger.info("Synced {} stream_urls rows into {}".format(fetched, path))
+    return fetched
@@ -0,0 +1,263 @@
+"""Run several analyses over the crawl database in a single pass.
+
+Each analysis is a `Consumer` declaring the rows it needs from each table.
+`Scanner` reads every table once, in visit_id order, and hands each visit's
+rows to every consumer interested in that visit, so a full report costs one
+pass over the data no matter how many analyses it runs.
+
+The pass is split into visit_id ranges scanned by worker processes, each on
+its own read-only connection. Consumers that can't be split that way (see
+`Consumer.part`) make the scanner fall back to a single process.
+"""
+
+import concurrent.futures
+import itertools
+import logging
+import os
+import sqlite3
+from urllib.request import pathname2url
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# Ranges per worker, so workers finishing early pick up more of the scan.
+RANGES_PER_WORKER = 4
+
+# The crawl database is only read, so map as much of it as possible and give
+# each connection a large page cache.
+MMAP_SIZE = 1 << 40
+CACHE_SIZE_KIB = 1 << 18
+
+
+def connect_readonly(db_path):
+    """Open the SQLite database at `db_path` read-only, memory mapped."""
+    uri = "file:{}?mode=ro".format(pathname2url(os.path.abspath(db_path)))
+    conn = sqlite3.connect(uri, uri=True)
+    conn.execute("PRAGMA mmap_size = {};".format(MMAP_SIZE))
+    conn.execute("PRAGMA cache_size = -{};".format(CACHE_SIZE_KIB))
+    return conn
+
+
+class Consumer:
+    """An analysis fed one visit at a time by `Scanner`.
+
+    Subclasses set `tables` and `visits` and implement `visit` and `finish`.
+    To be scanned in parallel, they also implement `part`, `result` and
+    `merge`.
+
+    :cvar tables: dict of table -> (columns, condition) the consumer needs.
+        The condition is an SQL expression over the table's columns, or None
+        for every row.
+    :ivar visits: (after, until) range of visit_ids to consume, exclusive of
+        `after`, or None if there is nothing to do
+    """
+
+    tables = {}
+    visits = None
+
+    def first_visit(self):
+        """Return the lowest visit_id `wants` may accept."""
+        return self.visits[0] + 1
+
+    def wants(self, visit_id, site_url):
+        """Return True if the consumer should be handed this visit."""
+        after, until = self.visits
+        return after < visit_id <= until
+
+    def visit(self, visit_id, site_url, rows):
+        """Consume a visit.
+
+        :param rows: dict of table -> list of sqlite3.Row of the visit, with
+            the columns listed in `tables`
+        """
+        raise NotImplementedError
+
+    def part(self):
+        """Return a picklable copy of the consumer that has consumed nothing.
+
+        A part is handed the visits of one visit_id range in a worker process,
+        and its `result` is passed back to `merge`. Returns None if the
+        consumer can only be run in a single process.
+        """
+        return None
+
+    def result(self):
+        """Return what a part has computed from its visits, to be merged."""
+        raise NotImplementedError
+
+    def merge(self, result):
+        """Fold the `result` of a part into the consumer.
+
+        Results are merged in visit_id order, and before `finish`.
+        """
+        raise NotImplementedError
+
+    def finish(self):
+        """Return the consumer's result once every visit has been handed in.
+
+        Also called, without any visit, when `visits` is None.
+        """
+        raise NotImplementedError
+
+
+def _scan_range(db_path, parts, start, end):
+    """Scan visits `start` to `end` in a worker and return each part's result."""
+    Scanner(db_path)._scan(parts, start, end)
+    return [part.result() for part in parts]
+
+
+class Scanner:
+    """Hand the rows of each visit in the crawl database to consumers.
+
+    :param workers: number of worker processes, by default one per CPU. With
+        one worker, everything runs in the calling process.
+    """
+
+    def __init__(self, db_path, workers=None):
+        self.db_path = db_path
+        self.workers = workers or os.cpu_count() or 1
+
+    def _query(self, conn, table, consumers, start, end):
+        """Stream the rows `consumers` need from `table`, in visit_id order.
+
+        Each row gets a `_wanted<i>` column telling whether it meets the
+        condition of the i-th consumer, so rows needed by several consumers
+        are only read once.
+        """
+        columns = []
+        conditions = []
+        for consumer in consumers:
+            wanted, condition = consumer.tables[table]
+            columns.extend(c for c in wanted if c not in columns)
+            conditions.append("({})".format(condition or "1"))
+
+        flags = ["{} AS _wanted{}".format(c, i) for i, c in enumerate(conditions)]
+        query = """
+            SELECT visit_id, {columns}
+            FROM {table}
+            WHERE visit_id >= ? AND visit_id <= ? AND ({conditions})
+            ORDER BY visit_id;
+            """.format(
+            columns=", ".join(columns + flags),
+            table=table,
+            conditions=" OR ".join(conditions),
+        )
+        logger.info("SQL Query: {}".format(query))
+
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        return itertools.groupby(c.execute(query, (start, end)), key=lambda r: r[0])
+
+    def run(self, consumers):
+        """Scan the database once and return the result of each consumer."""
+        active = [c for c in consumers if c.visits is not None]
+        if active:
+            start = min(consumer.first_visit() for consumer in active)
+            end = max(consumer.visits[1] for consumer in active)
+            conn = connect_readonly(self.db_path)
+            ranges = self._ranges(conn, start, end)
+            conn.close()
+
+            if len(ranges) > 1 and all(c.part() is not None for c in active):
+                self._scan_parallel(active, ranges)
+            elif ranges:
+                with tqdm(total=sum(n for _, _, n in ranges)) as pbar:
+                    self._scan(active, start, end, pbar)
+        return [consumer.finish() for consumer in consumers]
+
+    def _ranges(self, conn, start, end):
+        """Split visits `start` to `end` into ranges of about as many visits.
+
+        :rtype: list of (first visit_id, last visit_id, number of visits)
+        """
+        count = conn.execute(
+            "SELECT count(*) FROM site_visits WHERE visit_id >= ? AND visit_id <= ?;",
+            (start, end),
+        ).fetchone()[0]
+        if not count:
+            return []
+
+        n = 1 if self.workers == 1 else min(count, self.workers * RANGES_PER_WORKER)
+        # Each range starts at the visit_id at its offset among the visits.
+        offsets = [count * i // n for i in range(n)] + [count]
+        firsts = [
+            conn.execute(
+                """
+                SELECT visit_id FROM site_visits
+                WHERE visit_id >= ? AND visit_id <= ?
+                ORDER BY visit_id LIMIT 1 OFFSET ?;
+                """,
+                (start, end, offset),
+            ).fetchone()[0]
+            for offset in offsets[1:-1]
+        ]
+        bounds = [start] + firsts + [end + 1]
+        return [
+            (bounds[i], bounds[i + 1] - 1, offsets[i + 1] - offsets[i])
+            for i in range(n)
+        ]
+
+    def _scan_parallel(self, consumers, ranges):
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as executor:
+            futures = [
+                executor.submit(
+                    _scan_range,
+                    self.db_path,
+                    [consumer.part() for consumer in consumers],
+                    first,
+                    last,
+                )
+                for first, last, _ in ranges
+            ]
+            with tqdm(total=sum(n for _, _, n in ranges)) as pbar:
+                # Merge in visit_id order, as each range is done.
+                for future, (_, _, n) in zip(futures, ranges):
+                    for consumer, result in zip(consumers, future.result()):
+                        consumer.merge(result)
+                    pbar.update(n)
+
+    def _scan(self, consumers, start, end, pbar=None):
+        conn = connect_readonly(self.db_path)
+        tables = dict()
+        for table in sorted({t for consumer in consumers for t in consumer.tables}):
+            readers = [c for c in consumers if table in c.tables]
+            groups = self._query(conn, table, readers, start, end)
+            tables[table] = [readers, groups, next(groups, None)]
+
+        visits = conn.execute(
+            """
+            SELECT visit_id, site_url
+            FROM site_visits
+            WHERE visit_id >= ? AND visit_id <= ?
+            ORDER BY visit_id;
+            """,
+            (start, end),
+        )
+
+        for visit_id, site_url in visits:
+            if pbar is not None:
+                pbar.update(1)
+            wanting = [c for c in consumers if c.wants(visit_id, site_url)]
+
+            rows = {consumer: dict() for consumer in wanting}
+            for table, state in tables.items():
+                readers, groups, group = state
+                # Skip rows of visits without a site_visits entry.
+                while group is not None and group[0] < visit_id:
+                    group = next(groups, None)
+                visit_rows = []
+                if group is not None and group[0] == visit_id:
+                    visit_rows = list(group[1])
+                    group = next(groups, None)
+                state[2] = group
+
+                for i, consumer in enumerate(readers):
+                    if consumer in rows:
+                        flag = "_wanted{}".format(i)
+                        rows[consumer][table] = [r for r in visit_rows if r[flag]]
+
+            for consumer in wanting:
+                consumer.visit(visit_id, site_url, rows[consumer])
+
+        conn.close()
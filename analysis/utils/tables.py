@@ -0,0 +1,184 @@
+"""Roll per-CP frames up into the per-host and per-aggregator tables.
+
+Each table starts from a DataFrame with a row per CP. It is grouped by host
+or by aggregator with a pandas groupby, sorted, and printed as LaTeX rows
+with `latex_rows`. Groups keep the order in which they first appear, and
+ties keep it too, as the tables printed from dicts used to.
+"""
+
+import logging
+import re
+
+import pandas as pd
+
+from utils.database import get_aggregators
+
+logger = logging.getLogger(__name__)
+
+# (pattern, canonical name) of the hosting companies registered under several
+# network or AS organization names. A host takes the name of the first pattern
+# it contains.
+HOST_ALIASES = [
+    ("SC-QUASI", "SC-QUASI"),
+    ("Quasi Networks", "SC-QUASI"),
+    ("AMAZON", "AMAZON"),
+    ("Amazon", "AMAZON"),
+    ("SERVERIUS", "NL_SERVERIUS"),
+    ("Serverius", "NL_SERVERIUS"),
+    ("GOOGLE", "GOOGLE"),
+    ("Google", "GOOGLE"),
+    ("AMANAH", "AMANAH"),
+    ("Amanah", "AMANAH"),
+    ("DADDY", "GODADDY"),
+    ("GoDaddy", "GODADDY"),
+    ("CLIENTID", "PRIVATELAYER"),
+    ("Private Layer", "PRIVATELAYER"),
+    ("PIHLTD", "PrivateInternetHosting"),
+    ("Private Internet Hosting", "PrivateInternetHosting"),
+    ("HostPalace", "HOSTPALACE"),
+    ("HOSTPALACE", "HOSTPALACE"),
+    ("MAROSNET", "MAROSNET"),
+    ("NAMEC", "NAMECHEAP"),
+    ("NCNET", "NAMECHEAP"),
+    ("Namecheap", "NAMECHEAP"),
+    ("IFASTNET", "IFASTNET"),
+    ("iFastNet", "IFASTNET"),
+    ("HETZNER", "HETZNER"),
+    ("Hetzner", "HETZNER"),
+    ("DO-13", "DIGITALOCEAN"),
+    ("DIGITALOCEAN", "DIGITALOCEAN"),
+    ("OVH", "OVH"),
+]
+
+# Alternatives are tried in order, so the group that matched is that of the
+# first pattern the host contains.
+HOST_PATTERN = re.compile(
+    "|".join("(?=.*?({}))".format(pattern) for pattern, _ in HOST_ALIASES)
+)
+
+# Host of the CPs whose network has no name
+NO_HOST = "N/A"
+
+
+def _canonical_host(host):
+    match = HOST_PATTERN.match(host)
+    if match is None:
+        return host
+    return HOST_ALIASES[match.lastindex - 1][1]
+
+
+def normalize_hosts(hosts):
+    """Return `hosts` with each company under its canonical name.
+
+    Each distinct host is only matched once. Missing hosts become NO_HOST.
+    """
+    hosts = hosts.fillna(NO_HOST)
+    names = {host: _canonical_host(host) for host in hosts.unique()}
+    return hosts.map(names)
+
+
+def _truthy(values):
+    """Return whether each value is neither missing nor empty."""
+    return values.fillna("").astype(bool)
+
+
+def host_table(data, stream_counts, total):
+    """Return the CPs of `data` rolled up per hosting company.
+
+    A host's country is the host country of its first CP, or else its AS
+    country, or else the first host country of its other CPs. Other CPs
+    hosted in another country are logged.
+
+    :param data: DataFrame with the base_url, asn_num, asn_country,
+        host_country and host of each CP
+    :param stream_counts: dict of base_url -> number of stream URLs
+    :param total: number of stream URLs in all
+    :rtype: DataFrame indexed by host, with the country, AS number, number
+        of CPs and percentage of stream URLs of each, most CPs first
+    """
+    data = data.assign(host=normalize_hosts(data["host"]))
+    data = data[data["host"] != NO_HOST]
+
+    first = data.drop_duplicates("host").set_index("host")
+    country = first["host_country"].where(
+        _truthy(first["host_country"]), first["asn_country"]
+    )
+    listed = data[_truthy(data["host_country"])]
+    listed = listed.drop_duplicates("host").set_index("host")["host_country"]
+    listed = listed.reindex(country.index)
+    country = country.mask(~_truthy(country) & listed.notna(), listed)
+
+    conflicts = data[
+        _truthy(data["host_country"])
+        & (data["host_country"] != data["host"].map(country))
+    ]
+    for row in conflicts.itertuples():
+        logger.warning(
+            "{} in {} != {}: {}".format(
+                row.host, country[row.host], row.host_country, row.base_url
+            )
+        )
+
+    cps = data.drop_duplicates(["host", "base_url"])
+    streams = cps["base_url"].map(stream_counts).groupby(cps["host"], sort=False)
+    table = pd.DataFrame(
+        {
+            "country": country,
+            "asn": first["asn_num"],
+            "num_cps": data.groupby("host", sort=False).size(),
+            "streams": 100 * streams.sum() / total,
+        }
+    )
+    return table.sort_values("num_cps", ascending=False, kind="stable")
+
+
+def first_aggregators(cps):
+    """Return the aggregator credited with each of `cps`, indexed by CP.
+
+    That is the first aggregator linking to the CP.
+    """
+    cps = list(cps)
+    return pd.Series(
+        [get_aggregators(cp)[0] for cp in cps], index=cps, name="aggregator"
+    )
+
+
+def aggregator_rollup(per_cp, how="sum"):
+    """Roll the columns of `per_cp`, indexed by CP, up to aggregators.
+
+    :param how: aggregation of the CPs of an aggregator, e.g. "sum" or "mean"
+    :rtype: DataFrame indexed by aggregator, in order of first appearance
+    """
+    return per_cp.groupby(first_aggregators(per_cp.index), sort=False).agg(how)
+
+
+def tracking_table(aggregates):
+    """Return the trackers of the CPs of `aggregates` per aggregator.
+
+    :param aggregates: CPAggregates of the third parties or cookies of CPs
+    :rtype: DataFrame indexed by aggregator, with the total, trackers and
+        times_visited of its CPs, the share of trackers (percentage) and the
+        trackers per page, most trackers per page first
+    """
+    per_cp = pd.DataFrame(
+        {
+            "total": aggregates.totals,
+            "trackers": aggregates.trackers,
+            "times_visited": aggregates.times_visited,
+        },
+        index=list(aggregates.cps),
+    )
+    table = aggregator_rollup(per_cp)
+    table["percentage"] = table["trackers"] / table["total"]
+    table["trackers_per_page"] = table["trackers"] / table["times_visited"]
+    return table.sort_values("trackers_per_page", ascending=False, kind="stable")
+
+
+def latex_rows(table, row_format, num_rows=None):
+    """Print the first `num_rows` rows of `table` as LaTeX table rows.
+
+    :param row_format: format string of a row, given the index and then the
+        columns of `table` as positional arguments
+    """
+    for row in table.head(num_rows).itertuples():
+        print(row_format.format(*row))
@@ -0,0 +1,104 @@
+"""Track the highest visit_id an analysis cache covers.
+
+Each cache file gets a sidecar, ``<cache>.watermark``, recording the highest
+visit_id merged into it and a hash of the cache file itself. A refresh then
+only needs to process visits after the watermark. If the cache was changed
+without updating its sidecar (or a run died between writing the two), the
+hash no longer matches and the cache is rebuilt, as are caches written
+without a sidecar. The sidecar may also record the stage key (see
+`utils.memoize.stage_key`) of the inputs the visits were processed with; if
+those change, the cache covers no visits at all and is rebuilt from scratch.
+
+Refresh once a crawl has finished: visits still being written when the
+watermark is taken would otherwise be merged half complete.
+"""
+
+import json
+import logging
+import os
+
+from utils.memoize import file_digest
+from utils.scanner import connect_readonly
+
+logger = logging.getLogger(__name__)
+
+
+def _sidecar(path):
+    return path + ".watermark"
+
+
+def read_watermark(path, key=None):
+    """Return (max_visit_id, state) recorded for the cache at `path`.
+
+    Returns (None, None) if the cache has no usable watermark, and (0, None)
+    if it was computed from inputs other than `key`.
+    """
+    try:
+        with open(_sidecar(path)) as f:
+            watermark = json.load(f)
+        digest = file_digest(path)
+    except FileNotFoundError:
+        return (None, None)
+
+    if watermark["sha256"] != digest:
+        logger.warning("{} changed since its watermark was written".format(path))
+        return (None, None)
+    if watermark.get("key") != key:
+        logger.info("{} is stale, rebuilding".format(path))
+        return (0, None)
+    return (watermark["max_visit_id"], watermark.get("state"))
+
+
+def write_watermark(path, max_visit_id, state=None, key=None):
+    """Record that the cache at `path` covers visits up to `max_visit_id`.
+
+    Call this after the cache file itself has been written. `state` is any
+    JSON-able value a refresh needs besides the cache contents, and `key` the
+    stage key of the inputs other than the crawl database.
+    """
+    watermark = {
+        "key": key,
+        "max_visit_id": max_visit_id,
+        "sha256": file_digest(path),
+        "state": state,
+    }
+    tmp = _sidecar(path) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(watermark, f)
+    os.replace(tmp, _sidecar(path))
+
+
+def latest_visit_id(conn):
+    """Return the highest visit_id in the crawl database, or 0 if empty."""
+    return conn.execute("SELECT max(visit_id) FROM site_visits;").fetchone()[0] or 0
+
+
+def pending_visits(path, exists, db_path, key=None):
+    """Return the (after, until) visit_id range the cache at `path` lacks.
+
+    Visits with ``after < visit_id <= until`` still need to be merged in. If
+    `after` is 0 the cache must be rebuilt rather than merged into, which is
+    also the case of a cache without a usable watermark. Returns None if there
+    is nothing to refresh: the cache is up to date, or there is no crawl
+    database next to it.
+
+    :param exists: whether the cache has been written before
+    :param key: stage key of the inputs other than the crawl database
+    """
+    if not exists:
+        after = 0
+    else:
+        if not os.path.exists(db_path):
+            return None
+        after, _ = read_watermark(path, key)
+        if after is None:
+            logger.info("{} has no watermark, rebuilding".format(path))
+            after = 0
+
+    conn = connect_readonly(db_path)
+    until = latest_visit_id(conn)
+    conn.close()
+
+    if until <= after:
+        return None
+    return (after, until)
@@ -53,6 +53,10 @@ class Browser:
 
         # thread to run commands issues from TaskManager
         self.command_thread = None
+        # (CommandSequence, start event, done event) the command thread runs
+        self.job = None
+        # condition signalled when a job is handed to the command thread
+        self.job_ready = None
         # queue for passing command tuples to BrowserManager
         self.command_queue = None
         # queue for receiving command execution status from BrowserManager
@@ -77,8 +81,7 @@ class Browser:
 
     def ready(self):
         """ return if the browser is ready to accept a command """
-        return (self.command_thread is None or
-                not self.command_thread.is_alive())
+        return self.job is None
 
     def set_visit_id(self, visit_id):
         self.curr_visit_id = visit_id
@@ -10,6 +10,7 @@ import plyvel
 import six
 from six.moves import range
 
+from ..utilities.js_symbols import SymbolTable, ensure_symbol_column
 from .BaseAggregator import RECORD_TYPE_CONTENT, BaseAggregator, BaseListener
 
 SQL_BATCH_SIZE = 1000
@@ -54,6 +55,7 @@ class LocalListener(BaseListener):
         db_path = manager_params['database_name']
         self.db = sqlite3.connect(db_path, check_same_thread=False)
         self.cur = self.db.cursor()
+        self.symbols = SymbolTable(self.cur)
         self.ldb_enabled = ldb_enabled
         if self.ldb_enabled:
             self.ldb = plyvel.DB(
@@ -96,6 +98,9 @@ class LocalListener(BaseListener):
         elif record[0] == RECORD_TYPE_CONTENT:
             self.process_content(record)
             return
+        elif record[0] == "javascript":
+            record[1]["symbol_id"] = self.symbols.intern(
+                record[1].get("symbol"))
         statement, args = self._generate_insert(
             table=record[0], data=record[1])
         for i in range(len(args)):
@@ -196,6 +201,7 @@ class LocalAggregator(BaseAggregator):
         """Create tables (if this is a new database)"""
         with open(SCHEMA_FILE, 'r') as f:
             self.db.executescript(f.read())
+        ensure_symbol_column(self.db)
         self.db.commit()
 
     def _get_last_used_ids(self):
@@ -1,8 +1,10 @@
 from __future__ import absolute_import, division
 
+import collections
 import copy
 import json
 import os
+import sys
 import threading
 import time
 
@@ -19,11 +21,11 @@ from .BrowserManager import Browser
 from .DataAggregator import LocalAggregator, S3Aggregator
 from .Errors import CommandExecutionError
 from .SocketInterface import clientsocket
+from .utilities.db_indexes import build_indexes
 from .utilities.platform_utils import get_configuration_string, get_version
 
 pickling_support.install()
 
-SLEEP_CONS = 0.1  # command sleep constant (in seconds)
 BROWSER_MEMORY_LIMIT = 1500  # in MB
 
 AGGREGATOR_QUEUE_LIMIT = 10000  # number of records in the queue
@@ -99,6 +101,12 @@ class TaskManager:
         self.closing = False
         self.failure_status = None
         self.threadlock = threading.Lock()
+        # Browsers whose command thread is idle, in the order they freed up.
+        # Guarded by scheduler_lock, and browser_freed is signalled whenever
+        # a browser is added.
+        self.scheduler_lock = threading.Lock()
+        self.browser_freed = threading.Condition(self.scheduler_lock)
+        self.ready_browsers = collections.deque()
         self.failurecount = 0
         if manager_params['failure_limit'] is not None:
             self.failure_limit = manager_params['failure_limit']
@@ -120,6 +128,7 @@ class TaskManager:
 
         # sets up the BrowserManager(s) + associated queues
         self.browsers = self._initialize_browsers(browser_params)
+        self._start_command_threads()
         self._launch_browsers()
 
         # start the manager watchdog
@@ -146,6 +155,17 @@ class TaskManager:
 
         return browsers
 
+    def _start_command_threads(self):
+        """ start the persistent command thread of each browser """
+        for browser in self.browsers:
+            browser.job_ready = threading.Condition(self.scheduler_lock)
+            self.ready_browsers.append(browser)
+            thread = threading.Thread(target=self._command_thread,
+                                      args=(browser, ))
+            browser.command_thread = thread
+            thread.daemon = True
+            thread.start()
+
     def _launch_browsers(self):
         """ launch each browser manager process / browser """
         for browser in self.browsers:
@@ -260,7 +280,13 @@ class TaskManager:
         <during_init> flag to indicator if this shutdown is occuring during
                       the TaskManager initialization
         """
-        self.closing = True
+        with self.scheduler_lock:
+            self.closing = True
+            # Let idle command threads exit
+            for browser in self.browsers:
+                if browser.job_ready is not None:
+                    browser.job_ready.notify()
+            self.browser_freed.notify_all()
 
         for browser in self.browsers:
             browser.shutdown_browser(during_init)
@@ -306,6 +332,8 @@ class TaskManager:
                 )
             if self.failure_status['ErrorType'] == 'CriticalChildException':
                 reraise(*pickle.loads(self.failure_status['Exception']))
+            if self.failure_status['ErrorType'] == 'CommandThreadException':
+                reraise(*self.failure_status['Exception'])
 
     # CRAWLER COMMAND CODE
 
@@ -331,75 +359,72 @@ class TaskManager:
                 agg_queue_size = self.data_aggregator.get_status()
 
         # Distribute command
+        start = None
         if index is None:
             # send to first browser available
-            command_executed = False
-            while True:
-                for browser in self.browsers:
-                    if browser.ready():
-                        browser.current_timeout = command_seq.total_timeout
-                        thread = self._start_thread(browser, command_seq)
-                        command_executed = True
-                        break
-                if command_executed:
-                    break
-                time.sleep(SLEEP_CONS)
-
+            browsers = None
         elif index == '*':
             # send the command to all browsers
-            command_executed = [False] * len(self.browsers)
-            while False in command_executed:
-                for i in range(len(self.browsers)):
-                    if self.browsers[i].ready() and not command_executed[i]:
-                        self.browsers[
-                            i].current_timeout = command_seq.total_timeout
-                        thread = self._start_thread(
-                            self.browsers[i], command_seq)
-                        command_executed[i] = True
-                time.sleep(SLEEP_CONS)
+            browsers = list(self.browsers)
         elif index == '**':
             # send the command to all browsers and sync it
-            condition = threading.Condition()  # block threads until ready
-            command_executed = [False] * len(self.browsers)
-            while False in command_executed:
-                for i in range(len(self.browsers)):
-                    if self.browsers[i].ready() and not command_executed[i]:
-                        self.browsers[
-                            i].current_timeout = command_seq.total_timeout
-                        thread = self._start_thread(
-                            self.browsers[i], command_seq, condition)
-                        command_executed[i] = True
-                time.sleep(SLEEP_CONS)
-            with condition:
-                condition.notifyAll()  # All browsers loaded, start
+            start = threading.Event()  # block threads until ready
+            browsers = list(self.browsers)
         elif 0 <= index < len(self.browsers):
             # send the command to this specific browser
-            while True:
-                if self.browsers[index].ready():
-                    self.browsers[
-                        index].current_timeout = command_seq.total_timeout
-                    thread = self._start_thread(
-                        self.browsers[index], command_seq)
-                    break
-                time.sleep(SLEEP_CONS)
+            browsers = [self.browsers[index]]
         else:
             self.logger.info(
                 "Command index type is not supported or out of range")
             return
 
-        if command_seq.blocking:
-            thread.join()
+        while True:
+            browser = self._wait_for_browser(browsers)
+            browser.current_timeout = command_seq.total_timeout
+            done = self._start_command(browser, command_seq, start)
+            if browsers is not None:
+                browsers.remove(browser)
+            if not browsers:
+                break
+
+        if start is not None:
+            start.set()  # All browsers loaded, start
+
+        if command_seq.blocking and done is not None:
+            done.wait()
             self._check_failure_status()
 
-    def _start_thread(self, browser, command_sequence, condition=None):
-        """  starts the command execution thread """
+    def _wait_for_browser(self, browsers):
+        """ block until one of <browsers> is ready, and take it
 
-        # Check status flags before starting thread
-        if self.closing:
-            self.logger.error(
-                "Attempted to execute command on a closed TaskManager")
-            return
-        self._check_failure_status()
+        <browsers> is a list of browsers, or None for any browser
+        """
+        with self.browser_freed:
+            while True:
+                for browser in self.ready_browsers:
+                    if browsers is None or browser in browsers:
+                        self.ready_browsers.remove(browser)
+                        return browser
+                self.browser_freed.wait()
+
+    def _start_command(self, browser, command_sequence, start=None):
+        """ hands the command sequence to the browser's command thread
+
+        Returns an event set once the command sequence has run, or None if
+        it was not started
+        """
+
+        # Check status flags before starting
+        try:
+            if self.closing:
+                self.logger.error(
+                    "Attempted to execute command on a closed TaskManager")
+                self._release_browser(browser)
+                return
+            self._check_failure_status()
+        except BaseException:
+            self._release_browser(browser)
+            raise
 
         browser.set_visit_id(self.data_aggregator.get_next_visit_id())
         self.sock.send(("site_visits", {
@@ -408,24 +433,57 @@ class TaskManager:
             "site_url": command_sequence.url
         }))
 
-        # Start command execution thread
-        args = (browser, command_sequence, condition)
-        thread = threading.Thread(target=self._issue_command, args=args)
-        browser.command_thread = thread
-        thread.daemon = True
-        thread.start()
-        return thread
+        # Wake up the command thread
+        done = threading.Event()
+        with self.scheduler_lock:
+            browser.job = (command_sequence, start, done)
+            browser.job_ready.notify()
+        return done
+
+    def _release_browser(self, browser):
+        """ marks the browser ready for another command sequence """
+        with self.scheduler_lock:
+            browser.job = None
+            self.ready_browsers.append(browser)
+            self.browser_freed.notify_all()
+
+    def _command_thread(self, browser):
+        """ runs the command sequences handed to a browser, one at a time """
+        while True:
+            with self.scheduler_lock:
+                while browser.job is None and not self.closing:
+                    browser.job_ready.wait()
+                if browser.job is None:
+                    return
+                command_sequence, start, done = browser.job
 
-    def _issue_command(self, browser, command_sequence, condition=None):
+            try:
+                self._issue_command(browser, command_sequence, start)
+            except Exception:
+                # Keep serving the browser; the failure is raised from the
+                # next command dispatched.
+                self.logger.critical(
+                    "BROWSER %i: Exception while executing command sequence. "
+                    "Setting failure status." % browser.crawl_id,
+                    exc_info=True)
+                self.failure_status = {
+                    'ErrorType': 'CommandThreadException',
+                    'CommandSequence': command_sequence,
+                    'Exception': sys.exc_info()
+                }
+            finally:
+                self._release_browser(browser)
+                done.set()
+
+    def _issue_command(self, browser, command_sequence, start=None):
         """
         sends command tuple to the BrowserManager
         """
         browser.is_fresh = False
 
-        # if this is a synced call, block on condition
-        if condition is not None:
-            with condition:
-                condition.wait()
+        # if this is a synced call, block until all browsers have it
+        if start is not None:
+            start.wait()
 
         reset = command_sequence.reset
         start_time = None
@@ -557,4 +615,12 @@ class TaskManager:
         if self.closing:
             self.logger.error("TaskManager already closed")
             return
+        build = (self.manager_params['output_format'] == 'local' and
+                 self.manager_params.get('build_indexes', False))
+        if build:
+            self.logger.info("Building post-crawl indexes after shutdown...")
         self._shutdown_manager()
+
+        # Only index once the aggregator has flushed every record to disk
+        if build:
+            build_indexes(self.manager_params['database_name'])
@@ -0,0 +1,30 @@
+/* This file is sourced once a crawl has finished (see
+ * utilities/db_indexes.py), so that building these indexes
+ * does not slow down ingest. Make sure everything is
+ * CREATE IF NOT EXISTS, since it may be run more than once.
+ */
+
+/*
+# http_requests
+ * Third party requests of each visit, in visit_id order, without
+ * touching the table itself.
+ */
+CREATE INDEX IF NOT EXISTS http_requests_third_party_visit
+    ON http_requests(visit_id, url)
+    WHERE is_third_party_channel = 1;
+
+/*
+# profile_cookies
+ */
+CREATE INDEX IF NOT EXISTS profile_cookies_visit
+    ON profile_cookies(visit_id, baseDomain);
+
+/*
+# javascript
+ */
+CREATE INDEX IF NOT EXISTS javascript_visit
+    ON javascript(visit_id);
+
+/* Requires symbol_id, which utilities/js_symbols.py backfills first. */
+CREATE INDEX IF NOT EXISTS javascript_symbol_id_visit
+    ON javascript(symbol_id, visit_id);
@@ -155,7 +155,18 @@ CREATE TABLE IF NOT EXISTS javascript(
     operation TEXT,
     value TEXT,
     arguments TEXT,
-    time_stamp TEXT NOT NULL
+    time_stamp TEXT NOT NULL,
+    symbol_id INTEGER
+);
+
+/*
+# js_symbols
+ * Interned javascript.symbol values, so analyses can select calls by
+ * javascript.symbol_id instead of matching strings on every row.
+ */
+CREATE TABLE IF NOT EXISTS js_symbols(
+    id INTEGER PRIMARY KEY,
+    symbol TEXT NOT NULL UNIQUE
 );
 
 /*
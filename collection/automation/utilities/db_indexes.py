@@ -0,0 +1,43 @@
+"""Build the indexes and statistics analysis queries need on a crawl database.
+
+Run this once a crawl has finished, e.g.
+
+    python -m automation.utilities.db_indexes ../data/crawl-data.sqlite
+
+`TaskManager.close()` runs it automatically when the `build_indexes` manager
+parameter is set.
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import sqlite3
+import sys
+
+from .js_symbols import backfill_symbols
+
+INDEX_FILE = os.path.join(os.path.dirname(__file__), '..', 'indexes.sql')
+
+
+def build_indexes(db_path):
+    """Create the post-crawl indexes on `db_path` and ANALYZE it."""
+    # Databases crawled before js_symbols existed need symbol_id first
+    backfill_symbols(db_path)
+
+    with open(INDEX_FILE, 'r') as f:
+        script = f.read()
+
+    con = sqlite3.connect(db_path)
+    try:
+        con.executescript(script)
+        # Let the query planner see the new indexes' selectivity
+        con.execute("ANALYZE")
+        con.commit()
+    finally:
+        con.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: %s <crawl database>" % sys.argv[0])
+        sys.exit(1)
+    build_indexes(sys.argv[1])
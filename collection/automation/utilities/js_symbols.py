@@ -0,0 +1,81 @@
+"""Intern javascript.symbol values into the js_symbols table.
+
+New crawls fill in javascript.symbol_id as records are ingested (see
+LocalListener). Databases crawled before that can be backfilled, e.g.
+
+    python -m automation.utilities.js_symbols ../data/crawl-data.sqlite
+
+which `build_indexes` also does before indexing symbol_id.
+"""
+from __future__ import absolute_import, print_function
+
+import sqlite3
+import sys
+
+
+def ensure_symbol_column(con):
+    """Add javascript.symbol_id to databases created before it existed."""
+    columns = [row[1] for row in con.execute("PRAGMA table_info(javascript)")]
+    if columns and 'symbol_id' not in columns:
+        con.execute("ALTER TABLE javascript ADD COLUMN symbol_id INTEGER")
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS js_symbols("
+        "id INTEGER PRIMARY KEY, symbol TEXT NOT NULL UNIQUE)"
+    )
+
+
+class SymbolTable(object):
+    """Map symbols to their js_symbols id, adding new ones as they are seen.
+
+    Ids are remembered in memory, as a crawl only ever calls a few hundred
+    distinct symbols.
+    """
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.ids = dict(
+            (symbol, symbol_id) for symbol_id, symbol in
+            cur.execute("SELECT id, symbol FROM js_symbols"))
+
+    def intern(self, symbol):
+        """Return the id of `symbol`, or None if there is no symbol."""
+        if symbol is None:
+            return None
+        try:
+            return self.ids[symbol]
+        except KeyError:
+            self.cur.execute(
+                "INSERT OR IGNORE INTO js_symbols (symbol) VALUES (?)",
+                (symbol,))
+            self.cur.execute(
+                "SELECT id FROM js_symbols WHERE symbol = ?", (symbol,))
+            symbol_id = self.ids[symbol] = self.cur.fetchone()[0]
+            return symbol_id
+
+
+def backfill_symbols(db_path):
+    """Fill in javascript.symbol_id wherever it is missing."""
+    con = sqlite3.connect(db_path)
+    try:
+        ensure_symbol_column(con)
+        con.execute(
+            "INSERT OR IGNORE INTO js_symbols (symbol) "
+            "SELECT DISTINCT symbol FROM javascript "
+            "WHERE symbol_id IS NULL AND symbol IS NOT NULL"
+        )
+        con.execute(
+            "UPDATE javascript SET symbol_id = ("
+            "SELECT id FROM js_symbols WHERE js_symbols.symbol = "
+            "javascript.symbol) "
+            "WHERE symbol_id IS NULL AND symbol IS NOT NULL"
+        )
+        con.commit()
+    finally:
+        con.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: %s <crawl database>" % sys.argv[0])
+        sys.exit(1)
+    backfill_symbols(sys.argv[1])
@@ -1,11 +1,12 @@
 from utils.get_sites import get_last_inspect, get_urls_to_inspect, update_last_scanned
 from utils.get_one_per_cp import get_urls_few_per_cp
-from utils.geolocate import GeoLocate
+from utils.geolocate import GeoLocate, Location
 
 __all__ = [
     "GeoLocate",
+    "Location",
     "get_last_inspect",
+    "get_urls_few_per_cp",
     "get_urls_to_inspect",
-    "get_urls_few_per_cp"
     "update_last_scanned",
 ]
@@ -0,0 +1,119 @@
+"""Shared connection to the stream database.
+
+Because we are using Google CloudSQL, the database is reached through
+cloud_sql_proxy on localhost:6543 (see `get_sites.get_last_inspect`). Every
+connection through the proxy pays a TCP and authentication handshake, so the
+helpers of this package share a small pool, created on first use, and borrow
+a connection from it for each query with `cursor()`.
+
+With STREAMS_REPLICA set to the path of a local replica of the database, made
+with analysis/sync_replica.py, the helpers use the replica instead. Scans
+recorded by `update_last_scanned` then only update the replica, and are
+overwritten by its next sync.
+"""
+import atexit
+import contextlib
+import datetime
+import logging
+import os
+import sqlite3
+
+import psycopg2
+import psycopg2.pool
+
+GCSQL_PWD = os.environ.get("GCSQL_PWD")
+STREAMS_REPLICA = os.environ.get("STREAMS_REPLICA")
+
+# Connections kept open at most, e.g. for helpers used from several threads
+MAX_CONNECTIONS = 4
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_pid = None
+
+
+def _get_pool():
+    """Return this process's connection pool, creating it if needed."""
+    global _pool, _pool_pid
+    # Connections can't be shared with a forked child.
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = psycopg2.pool.ThreadedConnectionPool(
+            1,
+            MAX_CONNECTIONS,
+            host="localhost",
+            port="6543",
+            dbname="postgres",
+            user="postgres",
+            password=GCSQL_PWD,
+        )
+        _pool_pid = os.getpid()
+    return _pool
+
+
+# The replica stores timestamps as UTC seconds since the epoch.
+sqlite3.register_converter(
+    "EPOCH",
+    lambda value: datetime.datetime.fromtimestamp(float(value), datetime.timezone.utc),
+)
+
+
+class _ReplicaCursor:
+    """A cursor on the replica taking the queries of a psycopg2 cursor."""
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, query, params=()):
+        return self._cur.execute(query.replace("%s", "?"), params)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+def timestamp(ticks):
+    """Return the query parameter for the Unix timestamp `ticks`."""
+    if STREAMS_REPLICA is None:
+        return psycopg2.TimestampFromTicks(ticks)
+    return ticks
+
+
+@contextlib.contextmanager
+def cursor(name=None):
+    """Yield a cursor on a pooled connection, or on the replica if configured.
+
+    The transaction is committed when the block exits, or rolled back if it
+    raises, and the connection goes back to the pool.
+
+    :param name: name of a server-side cursor to create, which streams the
+        rows of a query instead of fetching them all at once
+    """
+    if STREAMS_REPLICA is not None:
+        conn = sqlite3.connect(STREAMS_REPLICA, detect_types=sqlite3.PARSE_DECLTYPES)
+        try:
+            with conn:
+                yield _ReplicaCursor(conn.cursor())
+        finally:
+            conn.close()
+        return
+
+    pool = _get_pool()
+    conn = pool.getconn()
+    try:
+        with conn:
+            with conn.cursor(name) as cur:
+                yield cur
+    finally:
+        pool.putconn(conn)
+
+
+@atexit.register
+def close_all():
+    """Close the pooled connections of this process."""
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.closeall()
+    _pool = None
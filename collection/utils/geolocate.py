@@ -1,25 +1,74 @@
+import collections
+import functools
 import os
 import geoip2.database
+import geoip2.errors
 import logging
 
 logger = logging.getLogger(__name__)
 
+GEOLITE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# IPs whose lookups a GeoLocate remembers
+LRU_SIZE = 1 << 16
+
+Location = collections.namedtuple(
+    "Location", ["country", "iso_code", "asn", "organization"]
+)
+
 
 class GeoLocate:
-    def __init__(self):
-        """Setup geolocation."""
-        self.reader = geoip2.database.Reader(
-            os.path.dirname(os.path.realpath(__file__)) + "/GeoLite2-City.mmdb"
-        )
+    def __init__(self, lru_size=LRU_SIZE):
+        """Setup geolocation.
 
-    def locate(self, ip):
-        """Return country, iso_code for the given IP."""
+        The GeoLite2 databases are memory mapped, so lookups never leave the
+        machine. AS lookups need GeoLite2-ASN.mmdb next to GeoLite2-City.mmdb,
+        and find nothing without it.
+        """
+        self.reader = geoip2.database.Reader(GEOLITE_DIR + "/GeoLite2-City.mmdb")
+        asn_path = GEOLITE_DIR + "/GeoLite2-ASN.mmdb"
+        self.asn_reader = None
+        if os.path.exists(asn_path):
+            self.asn_reader = geoip2.database.Reader(asn_path)
+        else:
+            logger.warning("No {}, skipping AS lookups".format(asn_path))
+        self._lookup = functools.lru_cache(maxsize=lru_size)(self._lookup_ip)
+
+    def _lookup_ip(self, ip):
+        """Return the Location of `ip`, with None for what is unknown."""
         try:
             response = self.reader.country(ip)
+            country = response.country.name, response.country.iso_code
         except geoip2.errors.AddressNotFoundError:
             logger.debug("Could not locate {}".format(ip))
-            return None, None
-        return response.country.name, response.country.iso_code
+            country = None, None
+
+        asn = None, None
+        if self.asn_reader is not None:
+            try:
+                response = self.asn_reader.asn(ip)
+                asn = (
+                    response.autonomous_system_number,
+                    response.autonomous_system_organization,
+                )
+            except geoip2.errors.AddressNotFoundError:
+                logger.debug("Could not find the AS of {}".format(ip))
+        return Location(*country, *asn)
+
+    def locate(self, ip):
+        """Return country, iso_code for the given IP."""
+        return self._lookup(ip)[:2]
+
+    def asn(self, ip):
+        """Return the AS number and organization for the given IP."""
+        return self._lookup(ip)[2:]
+
+    def locate_many(self, ips):
+        """Return the Location of each of the given IPs, in order."""
+        return [self._lookup(ip) for ip in ips]
 
     def close(self):
         self.reader.close()
+        if self.asn_reader is not None:
+            self.asn_reader.close()
+        self._lookup.cache_clear()
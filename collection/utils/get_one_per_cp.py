@@ -1,135 +1,50 @@
-import calendar
-import psycopg2
 import logging
-from tqdm import tqdm
-import os
 import time
 
-GCSQL_PWD = os.environ["GCSQL_PWD"]
+from utils.database import cursor, timestamp
+from utils.get_sites import get_last_inspect
 
 logger = logging.getLogger(__name__)
 
+# Most recently accessed URLs to inspect per channel provider
+URLS_PER_CP = 10
 
-def get_last_inspect(inspector="OpenWPM"):
-    """Get the last time urls were scanned by OpenWPM
 
-    Because we are using Google CloudSQL, in order for this to work,
-    you must first run "./cloud_sql_proxy \
-    -instances=sports-streaming-security:us-west1:cs356-streams=tcp:6543 \
-    -credential_file=sports-streaming-security-64e6f13735d5.json" in another
-    terminal to set up port forwarding as required. Note that the second argument
-    in this command is the authentication file containing the private key for the
-    GCP instance, which you must get from Hudson.
-    More information can be found in db_setup.txt, in this directory.
+def get_urls_few_per_cp(inspector="OpenWPM", live_only=False):
+    """Get the most recently accessed URLS of each channel provider
 
+    The URLs are ranked and sampled per base_url by the database, in a single
+    query whose rows are streamed through a server-side cursor.
 
-    :param inspector: The name of the inspector scanning these urls
-    :rtype: int
-    """
-
-    # TODO: Return errors if this fails
-    conn = psycopg2.connect(
-        host="localhost",
-        port="6543",
-        dbname="postgres",
-        user="postgres",
-        password=GCSQL_PWD,
-    )
-    cur = conn.cursor()
-    select_cmd = (
-        "SELECT scanned FROM last_inspect WHERE inspector = '" + inspector + "'"
-    )
-    cur.execute(select_cmd)
-    rows = cur.fetchall()
-    last_time = rows[0][0]
-    cur.close()
-    conn.close()
-    logger.info(last_time)
-    return calendar.timegm(last_time.timetuple())
-
-
-def update_last_scanned(scan_time, inspector="OpenWPM"):
-    """Save the last time urls were added to the postgres database.
-
-    Because we are using Google CloudSQL, in order for this to work,
-    you must first run "./cloud_sql_proxy \
-    -instances=sports-streaming-security:us-west1:cs356-streams=tcp:6543 \
-    -credential_file=sports-streaming-security-64e6f13735d5.json" in another
-    terminal to set up port forwarding as required. Note that the second argument
-    in this command is the authentication file containing the private key for the
-    GCP instance, which you must get from Hudson.
-    More information can be found in db_setup.txt, in this directory.
-
-    This function returns positive on success, negative on failure
-
-    :param inspector: The name of the inspector that scanned
-    :param time: Unix timestamp of the last scan
-    :rtype: int
-    """
-
-    # TODO: Return errors if this fails
-    conn = psycopg2.connect(
-        host="localhost",
-        port="6543",
-        dbname="postgres",
-        user="postgres",
-        password=GCSQL_PWD,
-    )
-    cur = conn.cursor()
-    update_cmd = (
-        "UPDATE last_inspect SET "
-        "(scanned)"
-        "= (%s) WHERE inspector = '" + inspector + "'"
-    )
-    cur.execute(update_cmd, (psycopg2.TimestampFromTicks(scan_time),))
-    conn.commit()
-    cur.close()
-    conn.close()
-    return 0
-
-
-def get_urls_few_per_cp(inspector="OpenWPM"):
-    """Get all new URLS since the last successful inspection
-
+    :param live_only: For reddit gathered streams, only keep those posted
+        between 1 and 5 hours ago, as a proxy for the stream being live
     :rtype: List of Strings
     """
 
     last_inspect_time = get_last_inspect(inspector=inspector)
     last_inspect_time = 0
-    conn = psycopg2.connect(
-        host="localhost",
-        port="6543",
-        dbname="postgres",
-        user="postgres",
-        password=GCSQL_PWD,
-    )
-    cur = conn.cursor()
-    get_base_urls_cmd = "SELECT distinct base_url FROM stream_urls"
-    cur.execute(get_base_urls_cmd)
-    base_urls = [x[0] for x in cur.fetchall()]
-
-    sites = []
-    for base_url in tqdm(base_urls):
-        get_urls_cmd = (
-            "SELECT url, base_url, aggregator, created_on FROM stream_urls WHERE (last_access) > (%s) AND base_url = (%s) ORDER BY last_access DESC LIMIT 10"
+    conditions = "last_access > %s"
+    params = [timestamp(last_inspect_time)]
+    if live_only:
+        utcnow = int(time.time())
+        conditions += (
+            " AND (aggregator != 'reddit' OR (created_on > %s AND created_on < %s))"
         )
-        cur.execute(get_urls_cmd, (psycopg2.TimestampFromTicks(last_inspect_time), base_url))
-        rows = cur.fetchall()
-        sites_by_cp = {}
-        for row in rows:
-            if row[2] == "reddit":
-                # For reddit gathered streams we can use whether the stream was posted
-                # between 1 hour and 3 hours ago as a proxy for the stream being live
-                posted = calendar.timegm(row[3].timetuple())
-                utcnow = int(time.time())
-                # Only visit websites created between 1 and 5 hours ago
-                if not (utcnow - posted > 3600 and utcnow - posted < 18000):
-                    #continue
-                    pass
+        params += [timestamp(utcnow - 18000), timestamp(utcnow - 3600)]
+    get_urls_cmd = (
+        "SELECT url FROM ("
+        "SELECT url, base_url, ROW_NUMBER() OVER "
+        "(PARTITION BY base_url ORDER BY last_access DESC) AS n "
+        "FROM stream_urls WHERE " + conditions + ") AS ranked "
+        "WHERE n <= %s ORDER BY base_url, n"
+    )
+    params.append(URLS_PER_CP)
 
-            sites.append(row[0])
-        logger.info(f"{last_inspect_time}")
-        logger.info(f"{base_url} num_urls:{len(sites)}")
+    with cursor(name="urls_few_per_cp") as cur:
+        cur.execute(get_urls_cmd, params)
+        sites = [row[0] for row in cur]
+    logger.info(f"{last_inspect_time}")
+    logger.info(f"num_urls:{len(sites)}")
 
     return sites
 
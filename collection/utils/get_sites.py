@@ -1,10 +1,8 @@
 import calendar
-import psycopg2
 import logging
-import os
 import time
 
-GCSQL_PWD = os.environ["GCSQL_PWD"]
+from utils.database import cursor, timestamp
 
 logger = logging.getLogger(__name__)
 
@@ -27,22 +25,13 @@ def get_last_inspect(inspector="OpenWPM"):
     """
 
     # TODO: Return errors if this fails
-    conn = psycopg2.connect(
-        host="localhost",
-        port="6543",
-        dbname="postgres",
-        user="postgres",
-        password=GCSQL_PWD,
-    )
-    cur = conn.cursor()
     select_cmd = (
         "SELECT scanned FROM last_inspect WHERE inspector = '" + inspector + "'"
     )
-    cur.execute(select_cmd)
-    rows = cur.fetchall()
+    with cursor() as cur:
+        cur.execute(select_cmd)
+        rows = cur.fetchall()
     last_time = rows[0][0]
-    cur.close()
-    conn.close()
     logger.info(last_time)
     return calendar.timegm(last_time.timetuple())
 
@@ -67,23 +56,13 @@ def update_last_scanned(scan_time, inspector="OpenWPM"):
     """
 
     # TODO: Return errors if this fails
-    conn = psycopg2.connect(
-        host="localhost",
-        port="6543",
-        dbname="postgres",
-        user="postgres",
-        password=GCSQL_PWD,
-    )
-    cur = conn.cursor()
     update_cmd = (
         "UPDATE last_inspect SET "
         "(scanned)"
         "= (%s) WHERE inspector = '" + inspector + "'"
     )
-    cur.execute(update_cmd, (psycopg2.TimestampFromTicks(scan_time),))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with cursor() as cur:
+        cur.execute(update_cmd, (timestamp(scan_time),))
     return 0
 
 
@@ -94,19 +73,12 @@ def get_urls_to_inspect(inspector="OpenWPM"):
     """
 
     last_inspect_time = get_last_inspect(inspector=inspector)
-    conn = psycopg2.connect(
-        host="localhost",
-        port="6543",
-        dbname="postgres",
-        user="postgres",
-        password=GCSQL_PWD,
-    )
-    cur = conn.cursor()
     get_urls_cmd = (
         "SELECT url, aggregator, created_on FROM stream_urls WHERE (last_access) > (%s)"
     )
-    cur.execute(get_urls_cmd, (psycopg2.TimestampFromTicks(last_inspect_time),))
-    rows = cur.fetchall()
+    with cursor() as cur:
+        cur.execute(get_urls_cmd, (timestamp(last_inspect_time),))
+        rows = cur.fetchall()
     sites = []
     for row in rows:
         if row[1] == "reddit":